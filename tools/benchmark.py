@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of the WebSocket -> serial -> WebSocket path.
+
+Starts the Hornby Elite emulator (tools/elite_emulator.py), runs
+socket-server.py against it in a subprocess, and drives simulated WebSocket
+clients with a mix of throttle, function and getState actions. Each client
+drives its own loco and waits for the broadcast reflecting its action before
+sending the next one.
+
+Reports round-trip latency (client action -> matching broadcast received),
+WebSocket -> serial latency (client action -> frame accepted by the emulator),
+completed commands per second, serial utilisation and server CPU time per
+delivered event, and writes them as JSON so runs can be compared:
+
+    python3 tools/benchmark.py --clients 10 --duration 30 --output before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from elite_emulator import EliteEmulator  # noqa: E402
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                             "usr", "lib", "xpressnet-control", "socket-server.py")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+FIRST_LOCO = 3
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarise(values):
+    return {
+        "count": len(values),
+        "p50_ms": None if not values else round(percentile(values, 0.50) * 1000, 3),
+        "p99_ms": None if not values else round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": None if not values else round(max(values) * 1000, 3),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    # utime and stime are fields 14 and 15 of the full line
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        action, weight = part.split("=")
+        mix[action.strip()] = float(weight)
+    return mix
+
+
+class SimulatedClient:
+    def __init__(self, number, url, mix, think_time, timeout, subscribe, seed):
+        self.train_number = FIRST_LOCO + number
+        self.url = url
+        self.actions = list(mix)
+        self.weights = [mix[action] for action in self.actions]
+        self.think_time = think_time
+        self.timeout = timeout
+        self.subscribe = subscribe
+        self.random = random.Random(seed)
+        self.speed = 0
+        self.functions = [False] * 13
+        self.samples = []  # (action, sent at, round trip seconds, expected serial frame)
+        self.timeouts = 0
+        self.received = 0
+
+    async def run(self, stop_at):
+        async with websockets.connect(self.url, max_queue=None) as websocket:
+            if self.subscribe:
+                await websocket.send(json.dumps({"action": "subscribe", "train_numbers": [self.train_number]}))
+            while time.monotonic() < stop_at:
+                action = self.random.choices(self.actions, self.weights)[0]
+                request, matches, frame = self.next_request(action)
+                sent_at = time.monotonic()
+                await websocket.send(json.dumps(request))
+                if await self.wait_for(websocket, matches):
+                    self.samples.append((action, sent_at, time.monotonic() - sent_at, frame))
+                else:
+                    self.timeouts += 1
+                if self.think_time:
+                    await asyncio.sleep(self.random.expovariate(1.0 / self.think_time))
+
+    def next_request(self, action):
+        train_number = self.train_number
+        if action == "throttle":
+            self.speed = self.speed % 126 + 1
+            speed = self.speed
+            request = {"action": "throttle", "train_number": train_number, "speed": speed, "direction": 1}
+
+            def matches(data):
+                return data.get("train_number") == train_number and data.get("speed") == speed
+            return request, matches, (0xE4, 0x13, train_number, speed | 0x80)
+
+        if action == "function":
+            function_id = self.random.randrange(13)
+            switch = not self.functions[function_id]
+            self.functions[function_id] = switch
+            request = {"action": "function", "train_number": train_number,
+                       "function_id": function_id, "switch": int(switch)}
+
+            def matches(data):
+                functions = data.get("functions") or {}
+                return data.get("train_number") == train_number and functions.get(str(function_id)) == switch
+            return request, matches, None
+
+        request = {"action": "getState", "train_number": train_number}
+
+        def matches(data):
+            return data.get("train_number") == train_number and "speed" in data
+        return request, matches, (0xE3, 0x00, train_number, None)
+
+    async def wait_for(self, websocket, matches):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                message = json.loads(await asyncio.wait_for(websocket.recv(), remaining))
+            except asyncio.TimeoutError:
+                return False
+            self.received += 1
+            if matches(message.get("data") or {}):
+                return True
+
+
+def serial_latencies(samples, frame_log):
+    # Index accepted frames by (header, identification, address, value) -> arrival times
+    arrivals = {}
+    for arrived_at, frame in frame_log:
+        if len(frame) < 5:
+            continue
+        address = ((frame[2] & 0x3F) << 8) | frame[3]
+        value = frame[4] if frame[0] == 0xE4 else None
+        arrivals.setdefault((frame[0], frame[1], address, value), []).append(arrived_at)
+
+    latencies = []
+    for _, sent_at, _, expected in samples:
+        if expected is None:
+            continue
+        for arrived_at in arrivals.get(expected, ()):
+            if arrived_at >= sent_at:
+                latencies.append(arrived_at - sent_at)
+                break
+    return latencies
+
+
+async def wait_until_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with websockets.connect(url) as websocket:
+                while time.monotonic() < deadline:
+                    message = json.loads(await asyncio.wait_for(websocket.recv(), 1.0))
+                    if message.get("message") == "SocketStatus" and message["data"].get("Controller_Connected"):
+                        return
+                    await websocket.send(json.dumps({"action": "getControllerStatus"}))
+        except (OSError, asyncio.TimeoutError, websockets.ConnectionClosed):
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not become ready")
+
+
+async def drive(args, url, emulator, server):
+    await wait_until_ready(url, 20)
+    mix = parse_mix(args.mix)
+    clients = [
+        SimulatedClient(n, url, mix, args.think_time, args.timeout, not args.no_subscribe, args.seed + n)
+        for n in range(args.clients)
+    ]
+
+    emulator.frame_log.clear()
+    emulator.recording = True
+    start_stats = dict(emulator.stats)
+    start_cpu = process_cpu_seconds(server.pid)
+    started = time.monotonic()
+    await asyncio.gather(*(client.run(started + args.duration) for client in clients))
+    elapsed = time.monotonic() - started
+    cpu = process_cpu_seconds(server.pid) - start_cpu
+    emulator.recording = False
+
+    samples = [sample for client in clients for sample in client.samples]
+    by_action = {}
+    for action, _, round_trip, _ in samples:
+        by_action.setdefault(action, []).append(round_trip)
+    received = sum(client.received for client in clients)
+    serial_bytes = (emulator.stats["bytes_in"] - start_stats["bytes_in"]) + \
+                   (emulator.stats["bytes_out"] - start_stats["bytes_out"])
+    serial_frames = emulator.stats["frames"] - start_stats["frames"]
+
+    return {
+        "duration_s": round(elapsed, 3),
+        "commands": len(samples),
+        "timeouts": sum(client.timeouts for client in clients),
+        "commands_per_second": round(len(samples) / elapsed, 2),
+        "round_trip": summarise([sample[2] for sample in samples]),
+        "round_trip_by_action": {action: summarise(values) for action, values in by_action.items()},
+        "websocket_to_serial": summarise(serial_latencies(samples, list(emulator.frame_log))),
+        "serial_frames": serial_frames,
+        "serial_frames_per_second": round(serial_frames / elapsed, 2),
+        "serial_busy_replies": emulator.stats["busy"] - start_stats["busy"],
+        "serial_utilisation": round(serial_bytes * 10.0 / args.baud / elapsed, 4),
+        "events_received": received,
+        "server_cpu_s": round(cpu, 3),
+        "server_cpu_ms_per_event": round(cpu * 1000 / received, 4) if received else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark socket-server.py against the Elite emulator")
+    parser.add_argument("--clients", type=int, default=4, help="Number of simulated WebSocket clients")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to drive load for")
+    parser.add_argument("--mix", default="throttle=70,function=20,getState=10",
+                        help="Weighted action mix, e.g. throttle=70,function=20,getState=10")
+    parser.add_argument("--think-time", type=float, default=0.05, help="Mean pause between a client's actions")
+    parser.add_argument("--timeout", type=float, default=2.0, help="Seconds to wait for an action's broadcast")
+    parser.add_argument("--no-subscribe", action="store_true", help="Clients receive every broadcast")
+    parser.add_argument("--command-delay", type=float, default=0.25, help="COMMAND_DELAY passed to the server")
+    parser.add_argument("--baud", type=int, default=19200)
+    parser.add_argument("--busy-rate", type=float, default=0.0, help="Emulator busy reply probability")
+    parser.add_argument("--min-gap", type=float, default=0.0, help="Emulator minimum gap between commands")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra configuration for the server, may be repeated")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="xpressnet-benchmark-")
+    link = os.path.join(workdir, "elite")
+    emulator = EliteEmulator(baud=args.baud, busy_rate=args.busy_rate, min_gap=args.min_gap,
+                             link=link, seed=args.seed)
+    emulator.start()
+
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "CONFIG_FILE": os.devnull,
+        "SERIAL_DEVICE": link,
+        "SERIAL_BAUD": str(args.baud),
+        "COMMAND_DELAY": str(args.command_delay),
+        "WEBSOCKET_PORT": str(port),
+        "HTTP_SERVER_ENABLE": "FALSE",
+        "MDNS_ENABLE": "FALSE",
+        "STATE_DIR": "",  # Keep synthetic loco state out of an installed server's journal
+    })
+    for setting in args.server_env:
+        name, value = setting.split("=", 1)
+        env[name] = value
+
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT], env=env, cwd=os.path.dirname(SERVER_SCRIPT),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        results = asyncio.run(drive(args, f"ws://127.0.0.1:{port}", emulator, server))
+    finally:
+        server.terminate()
+        server.wait()
+        emulator.stop()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""Hornby Elite emulator on a Linux pseudo-terminal.
+
+Speaks the subset of xpressNet used by xpressNet.py so the server can be run
+and benchmarked without a real controller:
+
+    21 21  version request        -> 63 21 <version> 00
+    21 24  status request         -> 62 22 <status>
+    21 80  emergency off          -> 61 00 (track power off)
+    21 81  resume operations      -> 61 01 (normal operations resumed)
+    E4 13  speed and direction    -> 01 04 (command OK)
+    E4 2x  function group         -> 01 04
+    E3 00  loco information       -> E4 04 <speed> <F0-F4> <F5-F12>
+    E3 08  functions F13-F28      -> E3 52 <F13-F20> <F21-F28>
+    52     accessory operation    -> 01 04
+
+Replies are delayed by the time the bytes would take on the wire at the
+configured baud rate. Busy replies (61 81) are sent at random and whenever
+commands arrive closer together than --min-gap, and the port can be made to
+disappear at random to exercise reconnection.
+
+Run it and point SERIAL_DEVICE in xpressnet-control.conf at the printed path
+(or at --link, which stays the same across emulated disconnects):
+
+    python3 tools/elite_emulator.py --link /tmp/elite --busy-rate 0.01
+"""
+import argparse
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+from functools import reduce
+
+COMMAND_OK = b'\x01\x04'
+TRACK_POWER_OFF = b'\x61\x00'
+NORMAL_OPERATIONS_RESUMED = b'\x61\x01'
+TRANSMISSION_ERROR = b'\x61\x80'
+COMMAND_STATION_BUSY = b'\x61\x81'
+COMMAND_NOT_SUPPORTED = b'\x61\x82'
+
+FUNCTION_GROUP_HEADERS = {0x20: 0, 0x21: 1, 0x22: 2, 0x23: 3, 0x28: 4}
+
+
+def checksum(data):
+    return reduce(lambda r, v: r ^ v, data, 0)
+
+
+def with_checksum(data):
+    return bytes(data) + bytes([checksum(data)])
+
+
+def decode_address(high_byte, low_byte):
+    return ((high_byte & 0x3F) << 8) | low_byte
+
+
+class Loco:
+    __slots__ = ("speed_direction", "group")
+
+    def __init__(self):
+        self.speed_direction = 0x80  # Stopped, forward
+        self.group = [0, 0, 0, 0, 0]
+
+
+class EliteEmulator:
+    def __init__(self, baud=19200, version=1.50, busy_rate=0.0, min_gap=0.0, latency=0.002,
+                 disconnect_interval=0.0, disconnect_duration=1.0, link=None, seed=None):
+        self.baud = baud
+        self.version = version
+        self.busy_rate = busy_rate
+        self.min_gap = min_gap
+        self.latency = latency
+        self.disconnect_interval = disconnect_interval
+        self.disconnect_duration = disconnect_duration
+        self.link = link
+        self.random = random.Random(seed)
+
+        self.locos = {}
+        self.accessories = {}
+        self.track_power = True
+        self.master = None
+        self.slave = None
+        self.device = None
+        self.running = False
+        self.disconnect_requested = False
+        self.thread = None
+        self.last_command_time = 0.0
+        self.stats = {
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "frames": 0,
+            "busy": 0,
+            "transmission_errors": 0,
+            "disconnects": 0,
+        }
+        self.frame_log = []  # (monotonic time, frame) of every accepted frame, when recording
+        self.recording = False
+
+    # Seconds the given number of bytes occupy the line (start + 8 data + stop bits)
+    def wire_time(self, length):
+        return length * 10.0 / self.baud
+
+    def open(self):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.master = master
+        self.device = os.ttyname(slave)
+        # Keep the slave open ourselves so the pty survives between client connections
+        self.slave = slave
+        if self.link:
+            temporary = f"{self.link}.tmp"
+            if os.path.lexists(temporary):
+                os.unlink(temporary)
+            os.symlink(self.device, temporary)
+            os.replace(temporary, self.link)
+        return self.device
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.master = None
+        self.slave = None
+
+    def start(self):
+        self.open()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.device
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.close()
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+
+    def run(self):
+        pending = bytearray()
+        next_disconnect = self.schedule_disconnect()
+        while self.running:
+            if self.disconnect_requested or (next_disconnect and time.monotonic() >= next_disconnect):
+                self.disconnect_requested = False
+                self.disconnect()
+                pending.clear()
+                next_disconnect = self.schedule_disconnect()
+                continue
+
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                continue
+            self.stats["bytes_in"] += len(data)
+            pending.extend(data)
+            self.process(pending)
+
+    def schedule_disconnect(self):
+        if self.disconnect_interval <= 0:
+            return None
+        return time.monotonic() + self.random.expovariate(1.0 / self.disconnect_interval)
+
+    # Ask the emulator thread to pull the cable now
+    def request_disconnect(self):
+        self.disconnect_requested = True
+
+    # Make the port disappear for a while, as when the USB cable is pulled
+    def disconnect(self):
+        self.stats["disconnects"] += 1
+        self.close()
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+        time.sleep(self.disconnect_duration)
+        self.open()
+
+    def process(self, pending):
+        while pending:
+            header = pending[0]
+            if header == 0x00:
+                # Stray byte between frames, skip it
+                del pending[0]
+                continue
+            length = (header & 0x0F) + 2
+            if len(pending) < length:
+                return
+            frame = bytes(pending[:length])
+            del pending[:length]
+            self.handle(frame)
+
+    def handle(self, frame):
+        now = time.monotonic()
+        gap = now - self.last_command_time
+        self.last_command_time = now
+
+        if checksum(frame) != 0:
+            self.stats["transmission_errors"] += 1
+            self.reply(TRANSMISSION_ERROR, len(frame))
+            return
+        if (self.min_gap and gap < self.min_gap) or (self.busy_rate and self.random.random() < self.busy_rate):
+            self.stats["busy"] += 1
+            self.reply(COMMAND_STATION_BUSY, len(frame))
+            return
+
+        self.stats["frames"] += 1
+        if self.recording:
+            self.frame_log.append((now, frame))
+        self.reply(self.execute(frame), len(frame))
+
+    def execute(self, frame):
+        header = frame[0]
+        if header == 0x21:
+            command = frame[1]
+            if command == 0x21:
+                return bytes([0x63, 0x21, int(round(self.version * 100)) & 0xFF, 0x00])
+            if command == 0x24:
+                return bytes([0x62, 0x22, 0x00 if self.track_power else 0x01])
+            if command == 0x80:
+                self.track_power = False
+                return TRACK_POWER_OFF
+            if command == 0x81:
+                self.track_power = True
+                return NORMAL_OPERATIONS_RESUMED
+            return COMMAND_NOT_SUPPORTED
+
+        if header == 0xE4:
+            loco = self.loco(frame[2], frame[3])
+            identification = frame[1]
+            if identification == 0x13:
+                loco.speed_direction = frame[4]
+                return COMMAND_OK
+            group_index = FUNCTION_GROUP_HEADERS.get(identification)
+            if group_index is not None:
+                loco.group[group_index] = frame[4]
+                return COMMAND_OK
+            return COMMAND_NOT_SUPPORTED
+
+        if header == 0xE3:
+            loco = self.loco(frame[2], frame[3])
+            if frame[1] == 0x00:
+                f5_f12 = (loco.group[1] & 0x0F) | ((loco.group[2] & 0x0F) << 4)
+                return bytes([0xE4, 0x04, loco.speed_direction, loco.group[0], f5_f12])
+            if frame[1] == 0x08:
+                return bytes([0xE3, 0x52, loco.group[3], loco.group[4]])
+            return COMMAND_NOT_SUPPORTED
+
+        if header == 0x52:
+            self.accessories[(frame[1], (frame[2] >> 1) & 0x03)] = frame[2] & 0x01
+            return COMMAND_OK
+
+        return COMMAND_NOT_SUPPORTED
+
+    def loco(self, high_byte, low_byte):
+        address = decode_address(high_byte, low_byte)
+        loco = self.locos.get(address)
+        if loco is None:
+            loco = self.locos[address] = Loco()
+        return loco
+
+    def reply(self, data, request_length):
+        message = with_checksum(data)
+        # The request and the reply both occupy the line before the reply is complete
+        time.sleep(self.latency + self.wire_time(request_length + len(message)))
+        try:
+            os.write(self.master, message)
+        except OSError:
+            return
+        self.stats["bytes_out"] += len(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate a Hornby Elite on a pseudo-terminal")
+    parser.add_argument("--baud", type=int, default=19200, help="Baud rate used to model wire timing")
+    parser.add_argument("--version", type=float, default=1.50, help="Version reported to 21 21")
+    parser.add_argument("--busy-rate", type=float, default=0.0, help="Probability of answering a command with busy")
+    parser.add_argument("--min-gap", type=float, default=0.0,
+                        help="Answer busy to commands arriving closer together than this many seconds")
+    parser.add_argument("--latency", type=float, default=0.002, help="Processing time per command in seconds")
+    parser.add_argument("--disconnect-interval", type=float, default=0.0,
+                        help="Mean seconds between random disconnects (0 disables)")
+    parser.add_argument("--disconnect-duration", type=float, default=1.0,
+                        help="Seconds the port stays away after a disconnect")
+    parser.add_argument("--link", help="Symlink kept pointing at the current pty")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible runs")
+    args = parser.parse_args()
+
+    emulator = EliteEmulator(
+        baud=args.baud,
+        version=args.version,
+        busy_rate=args.busy_rate,
+        min_gap=args.min_gap,
+        latency=args.latency,
+        disconnect_interval=args.disconnect_interval,
+        disconnect_duration=args.disconnect_duration,
+        link=args.link,
+        seed=args.seed,
+    )
+    device = emulator.start()
+    print(f"Hornby Elite emulator on {device}" + (f" (linked from {args.link})" if args.link else ""))
+    try:
+        while True:
+            time.sleep(10)
+            print(emulator.stats)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Replay a raw frame capture through the xpressNet decoder.
+
+Captures are recorded by socket-server.py when FRAME_CAPTURE_FILE is set (see
+capture.py for the format). Every received chunk is pushed through
+the process_data() of an xpressNet.Connection exactly as receive() would, and every sent frame
+that expects a reply is registered as an in-flight request so loco state
+replies are credited as they were live.
+
+By default the capture is decoded as fast as possible, each event is
+serialised to JSON as the broadcast does, and decoder throughput is reported:
+
+    python3 tools/replay.py session.xncap --repeat 100
+
+With --realtime the original gaps between frames are kept (scaled by
+--speed). With --serve the events go through socket-server.py's broadcast
+pipeline on the given WebSocket port, so a browser or the benchmark clients
+can watch the session again:
+
+    python3 tools/replay.py session.xncap --realtime --serve 8765
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "usr", "lib", "xpressnet-control")
+sys.path.insert(0, LIB_DIR)
+import capture  # noqa: E402
+import state  # noqa: E402
+import xpressNet  # noqa: E402
+
+# Sent frames (header, identification) -> reply headers they expect, as Train sends them
+REPLY_HEADERS = {
+    (0xE3, 0x00): (0xE4,),
+    (0xE3, 0x08): (0xE3,),
+}
+
+
+# Never opened, it only decodes what is pushed into its buffer
+connection = xpressNet.Connection(None)
+
+
+def expect_reply(frame):
+    if len(frame) < 4:
+        return
+    expects = REPLY_HEADERS.get((frame[0], frame[1]))
+    if expects is None:
+        return
+    request = xpressNet.Request(expects, xpressNet.decode_train_number(frame[2], frame[3]))
+    request.deadline = float("inf")  # Timing is not modelled, the reply always arrives
+    connection.inflight_requests.append(request)
+
+
+def reset_decoder(callback):
+    connection.buffer.clear()
+    connection.read_offset = 0
+    connection.inflight_requests.clear()
+    state.clear()
+    connection.callback = callback
+
+
+def replay(records, realtime=False, speed=1.0):
+    frames = chunks = size = 0
+    started = time.perf_counter()
+    first_timestamp = records[0][0] if records else 0.0
+    for timestamp, direction, data in records:
+        if realtime:
+            delay = (timestamp - first_timestamp) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        if direction == "tx":
+            expect_reply(data)
+            frames += 1
+            continue
+        chunks += 1
+        size += len(data)
+        connection.buffer.extend(data)
+        connection.process_data()
+    return frames, chunks, size, time.perf_counter() - started
+
+
+def load_server(port):
+    os.environ["WEBSOCKET_PORT"] = str(port)
+    os.environ["HTTP_SERVER_ENABLE"] = "FALSE"
+    spec = importlib.util.spec_from_file_location("socket_server", os.path.join(LIB_DIR, "socket-server.py"))
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+
+def serve(records, args):
+    server = load_server(args.serve)
+    loop_thread = threading.Thread(target=asyncio.run, args=(server.main(),))
+    loop_thread.daemon = True
+    loop_thread.start()
+    while server.event_loop is None:
+        time.sleep(0.05)
+
+    print(f"Waiting for a client on ws://0.0.0.0:{args.serve}, press Ctrl+C to stop")
+    reset_decoder(server.response_handler)
+    try:
+        while not server.connected_clients:
+            time.sleep(0.1)
+        for _ in range(args.repeat):
+            replay(records, args.realtime, args.speed)
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a frame capture through the xpressNet decoder")
+    parser.add_argument("capture", help="Capture file written with FRAME_CAPTURE_FILE")
+    parser.add_argument("--realtime", action="store_true", help="Keep the original timing between frames")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time scale for --realtime, 2 replays twice as fast")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times to replay the capture")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="Broadcast the events to WebSocket clients on this port")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    records = list(capture.read_capture(args.capture))
+    if args.serve:
+        serve(records, args)
+        return
+
+    events = []
+    reset_decoder(lambda event: events.append(event.to_json()))
+    frames = chunks = size = 0
+    elapsed = 0.0
+    for _ in range(args.repeat):
+        connection.inflight_requests.clear()
+        result = replay(records, args.realtime, args.speed)
+        frames += result[0]
+        chunks += result[1]
+        size += result[2]
+        elapsed += result[3]
+
+    report = {
+        "capture": args.capture,
+        "records": len(records),
+        "repeat": args.repeat,
+        "frames_sent": frames,
+        "chunks_received": chunks,
+        "bytes_received": size,
+        "events": len(events),
+        "elapsed_s": round(elapsed, 4),
+        "bytes_per_second": round(size / elapsed) if elapsed else None,
+        "events_per_second": round(len(events) / elapsed) if elapsed else None,
+        "unanswered_requests": len(connection.inflight_requests),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import struct
+import threading
+import time
+
+# Raw xpressNet frame capture. A capture is an append-only file starting with
+# MAGIC, followed by one record per frame sent ("tx") or chunk received ("rx"):
+#
+#   float64 wall-clock timestamp | uint8 direction | uint16 length | data
+#
+# Records are little-endian. A record cut short by a crash is ignored when
+# reading. The older text format (one "timestamp direction HEX" line per
+# frame) can be read as well.
+
+MAGIC = b"XNCAP1\n"
+RECORD = struct.Struct("<dBH")
+DIRECTIONS = ("tx", "rx")
+FLUSH_INTERVAL = 1.0  # Seconds between flushes of the write buffer
+
+class BinaryCaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.flush_pending = False
+
+    # Records are buffered and flushed at most FLUSH_INTERVAL after being written
+    def __call__(self, direction, data):
+        record = RECORD.pack(time.time(), DIRECTIONS.index(direction), len(data)) + bytes(data)
+        with self.lock:
+            self.file.write(record)
+            if not self.flush_pending:
+                self.flush_pending = True
+                timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+                timer.daemon = True
+                timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.flush_pending = False
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class TextCaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, "a", buffering=1)
+        self.lock = threading.Lock()
+
+    def __call__(self, direction, data):
+        line = f"{time.time():.6f} {direction} {data.hex().upper()}\n"
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def open_capture_writer(path, capture_format="binary"):
+    if capture_format == "text":
+        return TextCaptureWriter(path)
+    return BinaryCaptureWriter(path)
+
+# Yield (timestamp, direction, data) for every record in a capture file
+def read_capture(path):
+    with open(path, "rb") as capture_file:
+        content = capture_file.read()
+
+    if not content.startswith(MAGIC):
+        for line in content.decode("ascii", "replace").splitlines():
+            parts = line.split()
+            if len(parts) == 3 and parts[1] in DIRECTIONS:
+                yield float(parts[0]), parts[1], bytes.fromhex(parts[2])
+        return
+
+    view = memoryview(content)
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(content):
+        timestamp, direction, length = RECORD.unpack_from(content, offset)
+        offset += RECORD.size
+        if offset + length > len(content):
+            break  # Truncated final record
+        yield timestamp, DIRECTIONS[direction], bytes(view[offset:offset + length])
+        offset += length
@@ -0,0 +1,74 @@
+import threading
+import time
+
+import metrics
+import xpressNet
+
+# Command station health, tracked without touching the serial port on request.
+# One monitor watches each connection.
+# Liveness comes passively from received traffic; when the link has been
+# quiet for a probe interval a status request (0x21 0x24) is sent to prompt a
+# reply. The monitor thread refreshes a cached result every second, so status
+# queries only read it:
+#
+#   offline       the serial port is not open
+#   unresponsive  the port is open but nothing arrived for stale_after seconds
+#   online        the Elite answered recently
+
+PROBE_INTERVAL = 10.0  # Seconds of silence before a status probe is sent
+CHECK_INTERVAL = 1.0  # Seconds between updates of the cached result
+
+monitors = []  # Every started HealthMonitor, for the metrics
+
+def oldest_age():
+    ages = [monitor.result["last_received_age"] for monitor in list(monitors)]
+    if not ages or None in ages:
+        return float("nan")
+    return max(ages)
+
+probes = metrics.Counter("xpressnet_health_probes_total", "Status requests sent to check the Elite is alive.")
+metrics.Gauge("xpressnet_last_received_age_seconds", "Seconds since anything arrived from the Elite, the longest of all stations.",
+              oldest_age)
+
+class HealthMonitor:
+    def __init__(self, connection, probe_interval=PROBE_INTERVAL):
+        self.connection = connection
+        self.probe_interval = probe_interval
+        self.stale_after = probe_interval * 2 + xpressNet.REQUEST_TIMEOUT
+        self.probe = None  # Future of the outstanding probe
+        self.result = {"status": "offline", "checked_at": time.time(), "last_received_age": None}
+
+    def start(self):
+        monitors.append(self)
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    # The cached health: status, checked_at (epoch seconds), last_received_age (seconds or None)
+    def status(self):
+        return self.result
+
+    def run(self):
+        while True:
+            self.check()
+            time.sleep(CHECK_INTERVAL)
+
+    def check(self):
+        now = time.monotonic()
+        last_received = self.connection.get_last_received()
+        age = None if last_received is None else now - last_received
+
+        if not self.connection.is_controller_connected():
+            status = "offline"
+        else:
+            if (age is None or age >= self.probe_interval) and (self.probe is None or self.probe.done()):
+                try:
+                    self.probe = self.connection.probeStatus()
+                    probes.inc()
+                except xpressNet.XpressNetException:
+                    pass
+            status = "online" if age is not None and age < self.stale_after else "unresponsive"
+
+        # Replaced as a whole, so readers always see a consistent result
+        self.result = {"status": status, "checked_at": time.time(),
+                       "last_received_age": None if age is None else round(age, 3)}
@@ -0,0 +1,72 @@
+import ctypes
+import logging
+import os
+import select
+import struct
+import time
+
+# Device hotplug detection with Linux inotify (through ctypes, no extra
+# dependency). The directory holding the serial device is watched, so the
+# reconnect backoff can be cut short as soon as udev creates the node again
+# or changes its permissions. Where inotify is not available wait() simply
+# sleeps for the timeout.
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+class HotplugWatcher:
+    def __init__(self, device):
+        self.fd = None
+        self.name = os.path.basename(device).encode()
+        directory = os.path.dirname(os.path.abspath(device)).encode()
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            if libc.inotify_add_watch(fd, directory, IN_CREATE | IN_ATTRIB | IN_MOVED_TO) < 0:
+                error = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(error, f"Cannot watch {directory.decode()}")
+            self.fd = fd
+        except (OSError, AttributeError) as e:
+            logging.info("Hotplug detection unavailable, reconnecting on a timer: %s", e)
+
+    # Wait until the device appears or changes, or the timeout passes. Returns True if it did.
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if readable and self.device_changed():
+                return True
+
+    def device_changed(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return False
+        offset = 0
+        changed = False
+        while offset + EVENT.size <= len(data):
+            _, _, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            if data[offset:offset + length].rstrip(b"\0") == self.name:
+                changed = True
+            offset += length
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
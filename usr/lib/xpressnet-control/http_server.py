@@ -1,43 +1,309 @@
-import socket
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import asyncio
+import json
+import logging
 import os
-import threading
-import time
+import re
+import socket
+import metrics
+import state
+import xpressNet
+
+# HTTP status page and JSON REST API, served on the WebSocket server's event
+# loop so requests are handled concurrently and share its state. Loco and
+# accessory commands go through XpressNetController.batch(), which validates
+# them and only queues frames for the transmit thread. The status page is
+# rendered once and reused until the controller status or the state store
+# version changes.
+#
+#   GET  /                                  status page
+#   GET  /metrics                           Prometheus metrics
+#   GET  /api/status                        controller and transmit status
+#   GET  /api/locos                         cached state of every known loco
+#   GET  /api/locos/<n>                     cached state of one loco
+#   POST /api/locos/<n>/throttle            {"speed": 40, "direction": 1}
+#   POST /api/locos/<n>/stop
+#   POST /api/locos/<n>/functions/<id>      {"switch": 1}
+#   GET  /api/accessories                   accessory states set by clients
+#   POST /api/accessories/<n>/direction     {"direction": "FORWARD"}
+#   PUT  /api/accessories/<id>/state        {"state": ...}
+#   POST /api/batch                         {"commands": [...]} as the WebSocket batch action
+
+KEEPALIVE_TIMEOUT = 15.0  # Seconds an idle connection is kept open
+MAX_BODY = 65536
+
+REASONS = {200: "OK", 303: "See Other", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+http_requests = metrics.Counter("http_requests_total", "HTTP requests served, by status code.", "code")
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def json_response(status, data):
+    return status, "application/json", json.dumps(data).encode("utf-8"), {}
 
-class MyHTTPServer(HTTPServer):
-    def __init__(self, server_address, RequestHandlerClass, controller_getter, local_ip):
-        super().__init__(server_address, RequestHandlerClass)
-        self.get_controller = controller_getter
+def redirect(location):
+    return 303, "text/plain", b"", {"Location": location}
+
+def loco_state(address):
+    return xpressNet.loco_state_event(address).data
+
+class HttpServer:
+    def __init__(self, get_controller, local_ip, websocket_port, set_accessory_state, client_count):
+        self.get_controller = get_controller
         self.local_ip = local_ip
+        self.websocket_port = websocket_port
+        self.set_accessory_state = set_accessory_state  # Coroutine storing and broadcasting an accessory state
+        self.client_count = client_count
+        self.hostname = socket.gethostname()
+        self.train_test = os.getenv("TRAIN_3_TEST_ENABLE", "FALSE").upper() == "TRUE"
+        self.accessory_test = os.getenv("ACCESSORY_4_TEST_ENABLE", "FALSE").upper() == "TRUE"
+        self.page = None
+        self.page_key = None
+
+        # (method, path pattern, handler taking the match groups and the JSON body)
+        self.routes = [
+            ("GET", r"/", self.get_page),
+            ("GET", r"/metrics", self.get_metrics),
+            ("GET", r"/api/status", self.get_status),
+            ("GET", r"/api/locos", self.get_locos),
+            ("GET", r"/api/locos/(\d+)", self.get_loco),
+            ("POST", r"/api/locos/(\d+)/throttle", self.post_throttle),
+            ("POST", r"/api/locos/(\d+)/stop", self.post_stop),
+            ("POST", r"/api/locos/(\d+)/functions/(\d+)", self.post_function),
+            ("GET", r"/api/accessories", self.get_accessories),
+            ("POST", r"/api/accessories/(\d+)/direction", self.post_accessory_direction),
+            ("PUT", r"/api/accessories/([^/]+)/state", self.put_accessory_state),
+            ("POST", r"/api/batch", self.post_batch),
+            # Buttons on the status page
+            ("POST", r"/emergencyOff", self.form_command("emergencyOff")),
+            ("POST", r"/resumeNormalOperations", self.form_command("resumeNormalOperations")),
+            ("POST", r"/train3Forward", self.form_batch({"action": "throttle", "train_number": 3, "speed": 40, "direction": 1})),
+            ("POST", r"/train3Reverse", self.form_batch({"action": "throttle", "train_number": 3, "speed": 40, "direction": 0})),
+            ("POST", r"/train3Stop", self.form_batch({"action": "stop", "train_number": 3})),
+            ("POST", r"/f0On", self.form_batch({"action": "function", "train_number": 3, "function_id": 0, "switch": 1})),
+            ("POST", r"/f0Off", self.form_batch({"action": "function", "train_number": 3, "function_id": 0, "switch": 0})),
+            ("POST", r"/accessory4Forward", self.form_batch({"action": "setAccessoryDirection", "accessory_number": 4, "direction": "FORWARD"})),
+            ("POST", r"/accessory4Reverse", self.form_batch({"action": "setAccessoryDirection", "accessory_number": 4, "direction": "REVERSE"})),
+        ]
+        self.routes = [(method, re.compile(pattern + "$"), handler) for method, pattern, handler in self.routes]
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    await self.respond(writer, (400, "text/plain", b"Bad request", {}), False)
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.respond(writer, (400, "text/plain", b"Bad Content-Length", {}), False)
+                    break
+                if length > MAX_BODY:
+                    await self.respond(writer, (413, "text/plain", b"Request body too large", {}), False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                response = await self.dispatch(method, target.split("?", 1)[0], headers, body)
+                logging.debug("HTTP %s %s %s", method, target, response[0])
+                await self.respond(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, response, keep_alive):
+        status, content_type, payload, extra_headers = response
+        http_requests.inc(label=status)
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                f"Content-Type: {content_type}",
+                f"Content-Length: {len(payload)}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        head.extend(f"{name}: {value}" for name, value in extra_headers.items())
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+        await writer.drain()
+
+    async def dispatch(self, method, path, headers, body):
+        allowed = False
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            if route_method != method:
+                allowed = True
+                continue
+            try:
+                data = {}
+                if body and headers.get("content-type", "").startswith("application/json"):
+                    try:
+                        data = json.loads(body)
+                    except ValueError:
+                        raise HttpError(400, "Body is not valid JSON")
+                    if not isinstance(data, dict):
+                        raise HttpError(400, "Body must be a JSON object")
+                return await handler(*match.groups(), data)
+            except HttpError as e:
+                return json_response(e.status, {"status_code": e.status, "message": str(e)})
+            except Exception as e:
+                logging.exception("HTTP %s %s failed", method, path)
+                return json_response(500, {"status_code": 500, "message": f"Internal error: {e}"})
+        if allowed:
+            return json_response(405, {"status_code": 405, "message": "Method not allowed"})
+        return json_response(404, {"status_code": 404, "message": "Not found"})
+
+    def connected_controller(self):
+        controller = self.get_controller()
+        if controller is None or not controller.is_controller_connected():
+            raise HttpError(503, "Controller not connected")
+        return controller
+
+    # Run commands through the controller's batch validation and answer with the result
+    def run_batch(self, commands):
+        result = self.connected_controller().batch(commands)
+        return result.pop("status_code"), result
+
+    async def loco_command(self, command):
+        status, result = self.run_batch([command])
+        if status != 200:
+            return json_response(status, {"status_code": status, **result})
+        return json_response(200, {"status_code": 200, "message": result["message"],
+                                   "data": loco_state(command["train_number"])})
+
+    async def get_page(self, data):
+        controller = self.get_controller()
+        connected = bool(controller and controller.is_controller_connected())
+        key = (connected, state.epoch, state.current_version())
+        if key != self.page_key:
+            self.page = self.render_page(connected).encode("utf-8")
+            self.page_key = key
+        return 200, "text/html", self.page, {}
+
+    async def get_metrics(self, data):
+        return 200, "text/plain; version=0.0.4", metrics.render().encode("utf-8"), {}
+
+    async def get_status(self, data):
+        controller = self.get_controller()
+        connected = bool(controller and controller.is_controller_connected())
+        return json_response(200, {"status_code": 200, "data": {
+            "controller_connected": connected,
+            "clients": self.client_count(),
+            "health": controller.get_health() if controller else None,
+            "transmit": controller.get_transmit_stats() if controller else None,
+            "epoch": state.epoch,
+            "sequence": state.current_version(),
+        }})
+
+    async def get_locos(self, data):
+        return json_response(200, {"status_code": 200, "data": [loco_state(address) for address in state.addresses()]})
+
+    async def get_loco(self, address, data):
+        address = int(address)
+        if not state.valid_address(address) or not state.get_version(address):
+            raise HttpError(404, "Unknown loco")
+        return json_response(200, {"status_code": 200, "data": loco_state(address)})
+
+    async def post_throttle(self, address, data):
+        return await self.loco_command({"action": "throttle", "train_number": int(address),
+                                        "speed": data.get("speed"), "direction": data.get("direction")})
+
+    async def post_stop(self, address, data):
+        return await self.loco_command({"action": "stop", "train_number": int(address)})
+
+    async def post_function(self, address, function_id, data):
+        return await self.loco_command({"action": "function", "train_number": int(address),
+                                        "function_id": int(function_id), "switch": data.get("switch")})
+
+    async def get_accessories(self, data):
+        return json_response(200, {"status_code": 200, "data": state.accessories_changed_since(0)})
+
+    async def post_accessory_direction(self, accessory_number, data):
+        status, result = self.run_batch([{"action": "setAccessoryDirection", "accessory_number": int(accessory_number),
+                                          "direction": data.get("direction")}])
+        return json_response(status, {"status_code": status, **result})
+
+    async def put_accessory_state(self, accessory_id, data):
+        # Stored under the same integer ids the WebSocket clients use
+        try:
+            accessory_id = int(accessory_id)
+        except ValueError:
+            raise HttpError(400, "Invalid accessory id")
+        if not 0 <= accessory_id <= 1023:
+            raise HttpError(400, "Invalid accessory id")
+        if "state" not in data:
+            raise HttpError(400, "Missing field: state")
+        await self.set_accessory_state(accessory_id, data["state"])
+        return json_response(200, {"status_code": 200, "message": "Accessory state stored"})
+
+    async def post_batch(self, data):
+        status, result = self.run_batch(data.get("commands"))
+        return json_response(status, {"status_code": status, **result})
+
+    def form_command(self, method_name):
+        async def handler(data):
+            controller = self.get_controller()
+            if controller is not None:
+                logging.debug("%s triggered via web interface.", method_name)
+                getattr(controller, method_name)()
+            return redirect("/")
+        return handler
 
-class RequestHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        # Prepare the response data
-        hostname = socket.gethostname()
-        local_ip = self.server.local_ip
-        websocket_port = 8080
-        controller = self.server.get_controller()  # Use the getter function
-        controller_status = self.server.controller_status
+    def form_batch(self, command):
+        async def handler(data):
+            controller = self.get_controller()
+            if controller is not None:
+                logging.debug("%s triggered via web interface.", command)
+                controller.batch([command])
+            return redirect("/")
+        return handler
 
+    def render_page(self, connected):
+        rows = "".join(
+            f"<tr><td>{loco['train_number']}</td><td>{loco['speed']}</td><td>{loco['direction']}</td>"
+            f"<td>{', '.join('F' + number for number, on in loco['functions'].items() if on)}</td></tr>"
+            for loco in (loco_state(address) for address in state.addresses())
+        )
         response = f"""
         <html>
             <head><title>xpressNet Control</title></head>
             <body>
                 <h1>xpressNet Control Status</h1>
-                <p><strong>Hostname:</strong> {hostname}</p>
-                <p><strong>Local IP:</strong> {local_ip}</p>
-                <p><strong>WebSocket Port:</strong> {websocket_port}</p>
-                <p><strong>Controller Status:</strong> {controller_status}</p>
+                <p><strong>Hostname:</strong> {self.hostname}</p>
+                <p><strong>Local IP:</strong> {self.local_ip}</p>
+                <p><strong>WebSocket Port:</strong> {self.websocket_port}</p>
+                <p><strong>Controller Status:</strong> {"Connected" if connected else "Not Connected"}</p>
                 <form method="POST" action="/emergencyOff">
                     <button type="submit">Emergency Off</button>
                 </form>
                 <form method="POST" action="/resumeNormalOperations">
                     <button type="submit">Resume Normal Operations</button>
                 </form>
+                <h2>Locos</h2>
+                <table>
+                    <tr><th>Address</th><th>Speed</th><th>Direction</th><th>Functions on</th></tr>
+                    {rows}
+                </table>
         """
 
-        # Check if TRAIN_3_TEST_ENABLE is set to TRUE
-        if os.getenv("TRAIN_3_TEST_ENABLE", "FALSE").upper() == "TRUE":
+        if self.train_test:
             response += """
                 <h2>Train 3 Control Test</h2>
                 <form method="POST" action="/train3Forward">
@@ -57,8 +323,7 @@ class RequestHandler(BaseHTTPRequestHandler):
                 </form>
             """
 
-        # Check if ACCESSORY_4_TEST_ENABLE is set to TRUE
-        if os.getenv("ACCESSORY_4_TEST_ENABLE", "FALSE").upper() == "TRUE":
+        if self.accessory_test:
             response += """
                 <h2>Accessory 4 Control</h2>
                 <form method="POST" action="/accessory4Forward">
@@ -73,68 +338,11 @@ class RequestHandler(BaseHTTPRequestHandler):
             </body>
         </html>
         """
+        return response
 
-        # Send response
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(response.encode('utf-8'))
-
-    def do_POST(self):
-        controller = self.server.get_controller()  # Use the getter function
-        if controller is not None:
-            if self.path == '/emergencyOff':
-                print("Emergency Off triggered via web interface.")
-                controller.emergencyOff()
-            elif self.path == '/resumeNormalOperations':
-                print("Resume Normal Operations triggered via web interface.")
-                controller.resumeNormalOperations()
-            elif self.path == '/train3Forward':
-                print(f"Train 3 Throttle forward: Speed 40")
-                controller.throttle(3, 40, 1)
-            elif self.path == '/train3Reverse':
-                print(f"Train 3 Throttle reverse: Speed 40")
-                controller.throttle(3, 40, 0)
-            elif self.path == '/train3Stop':
-                print(f"Train 3: Stop")
-                controller.stop(3)
-            elif self.path == '/f0On':
-                print("Train 3 f0 - On triggered via web interface.")
-                controller.function(3, 0, True)
-            elif self.path == '/f0Off':
-                print("Train 3 f0 - Off triggered via web interface.")
-                controller.function(3, 0, False)
-            elif self.path == '/accessory4Forward':
-                print("Accessory 4 Forward triggered via web interface.")
-                controller.setAccessoryState(4, "FORWARD")
-            elif self.path == '/accessory4Reverse':
-                print("Accessory 4 Reverse triggered via web interface.")
-                controller.setAccessoryState(4, "REVERSE")
-
-        # Redirect back to the main page
-        self.send_response(303)
-        self.send_header('Location', '/')
-        self.end_headers()
-
-
-def update_controller_status(server):
-    """Update the controller status every 2 seconds."""
-    while True:
-        controller = server.get_controller()
-        if controller and controller.is_controller_connected():
-            server.controller_status = "Connected"
-        else:
-            server.controller_status = "Not Connected"
-        time.sleep(2)
-
-def start_http_server(controller_getter, local_ip):
-    http_port = int(os.getenv("HTTP_SERVER_PORT", 80))
-    server = MyHTTPServer(('0.0.0.0', http_port), RequestHandler, controller_getter, local_ip)
-
-     # Start the controller status update thread
-    status_thread = threading.Thread(target=update_controller_status, args=(server,))
-    status_thread.daemon = True  # Daemon thread will exit when the main program exits
-    status_thread.start()
-
-    print(f"HTTP server started on port {http_port}")
-    server.serve_forever()
\ No newline at end of file
+# Start serving on the running event loop, returns the asyncio server
+async def start_http_server(port, get_controller, local_ip, websocket_port, set_accessory_state, client_count):
+    http_server = HttpServer(get_controller, local_ip, websocket_port, set_accessory_state, client_count)
+    server = await asyncio.start_server(http_server.handle_connection, "0.0.0.0", port)
+    print(f"HTTP server started on port {port}")
+    return server
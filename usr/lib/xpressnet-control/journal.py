@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+import state
+
+# Crash-safe journal of the state store, so loco and accessory states survive
+# a restart. Changes are appended as JSON lines, one per changed loco or
+# accessory, and written out in batches: the state store only marks what
+# changed, and every SYNC_INTERVAL the writer appends the current state of
+# everything marked and fsyncs once. Once the journal holds COMPACT_RECORDS
+# records it is rewritten as a snapshot of the whole store next to it and
+# atomically renamed over the old file. A line cut short by a crash is
+# skipped when loading.
+
+SYNC_INTERVAL = 1.0  # Seconds between batched writes
+COMPACT_RECORDS = 10000  # Records appended before the journal is compacted
+
+journal_writes = metrics.Counter("state_journal_writes_total", "Batches of state changes written to the journal.")
+journal_compactions = metrics.Counter("state_journal_compactions_total", "Rewrites of the journal as a snapshot.")
+
+def loco_record(address):
+    return {"loco": address, "speed": state.get_speed_direction(address), "groups": list(state.get_groups(address))}
+
+def accessory_record(accessory_id, value):
+    return {"accessory": accessory_id, "state": value}
+
+class StateJournal:
+    def __init__(self, directory, sync_interval=SYNC_INTERVAL, compact_records=COMPACT_RECORDS):
+        self.path = os.path.join(directory, "state.journal")
+        self.sync_interval = sync_interval
+        self.compact_records = compact_records
+        self.dirty_locos = set()
+        self.dirty_accessories = set()
+        self.lock = threading.Lock()
+        self.records = 0
+        self.file = None
+
+    # Apply the journal to the state store. Returns the number of records read.
+    def load(self):
+        if not os.path.exists(self.path):
+            return 0
+        records = 0
+        with open(self.path, "rb") as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning("Skipping damaged state journal record")
+                    continue
+                if "loco" in record:
+                    address = record["loco"]
+                    if state.valid_address(address):
+                        state.set_speed_direction(address, record["speed"])
+                        state.set_groups(address, 0, record["groups"])
+                elif "accessory" in record:
+                    state.set_accessory(record["accessory"], record["state"])
+                records += 1
+        self.records = records
+        return records
+
+    # Called by the state store for every change
+    def changed(self, kind, key):
+        with self.lock:
+            if kind == "loco":
+                self.dirty_locos.add(key)
+            else:
+                self.dirty_accessories.add(key)
+
+    def start(self):
+        self.compact()
+        self.file = open(self.path, "a")
+        state.set_change_sink(self.changed)
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except OSError as e:
+                logging.error("Writing the state journal failed: %s", e)
+
+    # Append the current state of everything changed since the last sync
+    def sync(self):
+        with self.lock:
+            locos, self.dirty_locos = self.dirty_locos, set()
+            accessories, self.dirty_accessories = self.dirty_accessories, set()
+        if not locos and not accessories:
+            return
+
+        changes = state.accessories_changed_since(0)
+        lines = [json.dumps(loco_record(address)) for address in sorted(locos)]
+        lines.extend(json.dumps(accessory_record(accessory_id, changes[accessory_id]))
+                     for accessory_id in accessories if accessory_id in changes)
+        if self.file.closed:
+            self.file = open(self.path, "a")  # Reopened after a failed compaction
+        self.file.write("\n".join(lines) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        journal_writes.inc()
+
+        self.records += len(lines)
+        if self.records >= self.compact_records:
+            self.file.close()
+            try:
+                self.compact()
+            finally:
+                # If the compaction failed the old journal is still in place, keep appending to it
+                self.file = open(self.path, "a")
+
+    # Rewrite the journal as one record per known loco and accessory
+    def compact(self):
+        temporary = f"{self.path}.tmp"
+        lines = [json.dumps(loco_record(address)) for address in state.addresses()]
+        lines.extend(json.dumps(accessory_record(accessory_id, value))
+                     for accessory_id, value in state.accessories_changed_since(0).items())
+        with open(temporary, "w") as snapshot:
+            snapshot.write("".join(line + "\n" for line in lines))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self.path)
+        directory = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.records = len(lines)
+        journal_compactions.inc()
@@ -0,0 +1,89 @@
+import threading
+from bisect import bisect_left
+
+# Minimal Prometheus-style metrics. Metrics register themselves on creation and
+# render() produces the text exposition format served on /metrics.
+
+registry = []
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def format_labels(label_name, label_value):
+    if label_name is None:
+        return ""
+    return f'{{{label_name}="{label_value}"}}'
+
+class Counter:
+    def __init__(self, name, help_text, label_name=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: str(item[0]))
+        if not values and self.label_name is None:
+            values = [(None, 0)]
+        for label, value in values:
+            lines.append(f"{self.name}{format_labels(self.label_name, label)} {value}")
+        return lines
+
+# A gauge read from a function when the metrics are rendered
+class Gauge:
+    def __init__(self, name, help_text, function):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        registry.append(self)
+
+    def render(self):
+        try:
+            value = self.function()
+        except Exception:
+            value = float("nan")
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
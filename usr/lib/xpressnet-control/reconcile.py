@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+import metrics
+
+# Background reconciliation of the cached loco states with the Elite, so
+# changes made on the Elite's own knobs reach the clients. Only active locos
+# are polled: those watched by a client subscription and those commanded in
+# the last ACTIVE_WINDOW seconds. Each is read back at most once per interval,
+# watched and most recently used first.
+#
+# Polling is capped to a share of the serial link. The time each read-back
+# occupies the link is measured and the scheduler then idles long enough for
+# polling to use no more than that share. It also stays away from a command
+# station while user commands are waiting to be sent to it. Replies that only
+# confirm the cached state are not broadcast, and replies to a read-back
+# queued before a command changed the loco are dropped, so they cannot
+# overwrite the newer state.
+
+ACTIVE_WINDOW = 300.0  # Seconds a loco stays active after its last command
+IDLE_WAIT = 1.0  # Seconds to wait when there is nothing to do
+REPLY_WAIT = 5.0  # Seconds to wait for a read-back to complete
+
+refreshes = metrics.Counter("xpressnet_state_refreshes_total", "Background loco state read-backs, by result.", "result")
+
+class StateReconciler:
+    def __init__(self, get_controller, watched_trains, interval, share):
+        self.get_controller = get_controller
+        self.watched_trains = watched_trains  # Function returning the addresses clients subscribe to
+        self.interval = interval
+        self.share = share
+        self.last_refreshed = {}  # Address -> monotonic time of the last read-back
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    # The active address due for a read-back with the highest priority, or
+    # None. Locos on a station that is down or has commands queued wait.
+    def next_address(self, controller, now):
+        priorities = {address: used for address, used in list(controller.last_used.items()) if now - used < ACTIVE_WINDOW}
+        for address in self.watched_trains():
+            priorities[address] = now  # Watched locos come first
+        idle = {connection: connection.is_controller_connected() and not connection.get_transmit_queue_depth()
+                for connection in controller.connections}
+        due = [address for address in priorities
+               if now - self.last_refreshed.get(address, float("-inf")) >= self.interval
+               and idle[controller.station_for_loco(address)]]
+        if not due:
+            return None
+        return max(due, key=priorities.__getitem__)
+
+    def run(self):
+        while True:
+            controller = self.get_controller()
+            if controller is None or not controller.is_controller_connected():
+                time.sleep(IDLE_WAIT)
+                continue
+
+            now = time.monotonic()
+            address = self.next_address(controller, now)
+            if address is None:
+                time.sleep(IDLE_WAIT)
+                continue
+            connection = controller.station_for_loco(address)
+
+            self.last_refreshed[address] = now
+            started = time.monotonic()
+            try:
+                connection.get_train(address).getState(quiet=True).result(REPLY_WAIT)
+                refreshes.inc(label="ok")
+            except Exception as e:
+                logging.debug("State refresh of loco %s failed: %s", address, e)
+                refreshes.inc(label="failed")
+
+            # Idle so read-backs use at most share of the link
+            busy = time.monotonic() - started
+            time.sleep(busy * (1.0 - self.share) / self.share)
@@ -1,74 +1,330 @@
 import asyncio
 import websockets
 import json
+import logging
 import threading
 import time
 import socket
 import os
 import serial  # Ensure the import is correct for serial communication
+from collections import deque
+from contextlib import ExitStack
+from urllib.parse import urlparse, parse_qs
 from zeroconf import ServiceInfo, Zeroconf
 from dotenv import load_dotenv
 import xpressNet
+import metrics
+import capture
+import state
+import journal
+import reconcile
+import health
 from http_server import start_http_server  # Import the HTTP server module
 
 # Load environment variables from config.env
 CONFIG_FILE = os.getenv("CONFIG_FILE", "/etc/xpressnet-control/xpressnet-control.conf")
 load_dotenv(CONFIG_FILE)
 
+# Logging: LOG_LEVEL sets the level (per-command logging is at DEBUG),
+# TRACE_SAMPLE_RATE logs that fraction of serial frames at INFO, and
+# FRAME_CAPTURE_FILE appends every raw frame sent and received to a file
+# in FRAME_CAPTURE_FORMAT ("binary", replayable with tools/replay.py, or "text").
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):  # getLevelNamesMapping() needs Python 3.11
+    print(f"Unknown LOG_LEVEL {LOG_LEVEL}, using WARNING")
+    LOG_LEVEL = "WARNING"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0))
+FRAME_CAPTURE_FILE = os.getenv("FRAME_CAPTURE_FILE", "")
+FRAME_CAPTURE_FORMAT = os.getenv("FRAME_CAPTURE_FORMAT", "binary").lower()
+logging.basicConfig(level=LOG_LEVEL, format="%(levelname)s %(message)s")
+
+# Serial link to the Elite (SERIAL_DEVICE can point at tools/elite_emulator.py's pty for testing)
+SERIAL_DEVICE = os.getenv("SERIAL_DEVICE", "/dev/ttyACM0")
+SERIAL_BAUD = int(os.getenv("SERIAL_BAUD", 19200))
+COMMAND_DELAY = float(os.getenv("COMMAND_DELAY", 0.25))
+# A layout split across several command stations lists their names in
+# STATIONS. Each station NAME has its serial device in STATION_NAME_DEVICE and
+# the loco and accessory addresses it drives in STATION_NAME_LOCOS and
+# STATION_NAME_ACCESSORIES (ranges such as "1-99,200"); STATION_NAME_BAUD and
+# STATION_NAME_COMMAND_DELAY default to the settings above. Addresses outside
+# every range go to the first station. Without STATIONS, SERIAL_DEVICE drives
+# the whole layout.
+STATIONS = [name.strip() for name in os.getenv("STATIONS", "").split(",") if name.strip()]
+WEBSOCKET_PORT = int(os.getenv("WEBSOCKET_PORT", 8080))
+MDNS_ENABLE = os.getenv("MDNS_ENABLE", "TRUE").upper() == "TRUE"
+HTTP_SERVER_ENABLE = os.getenv("HTTP_SERVER_ENABLE", "FALSE").upper() == "TRUE"
+HTTP_SERVER_PORT = int(os.getenv("HTTP_SERVER_PORT", 80))
+# Report loco state from the command just sent instead of reading it back from the Elite
+OPTIMISTIC_STATE = os.getenv("OPTIMISTIC_STATE", "TRUE").upper() == "TRUE"
+# Background read-back of active locos from the Elite: at most once every
+# STATE_REFRESH_INTERVAL seconds per loco (0 disables), using no more than
+# STATE_REFRESH_SHARE of the serial link
+STATE_REFRESH_INTERVAL = float(os.getenv("STATE_REFRESH_INTERVAL", 30))
+STATE_REFRESH_SHARE = float(os.getenv("STATE_REFRESH_SHARE", 0.2))
+if not 0 < STATE_REFRESH_SHARE <= 1:
+    print(f"STATE_REFRESH_SHARE {STATE_REFRESH_SHARE} is outside (0, 1], using 0.2")
+    STATE_REFRESH_SHARE = 0.2
+# Seconds without traffic from the Elite before a status request is sent to check it is alive
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", 10))
+# Messages a client may have waiting (after coalescing) before it is disconnected as too slow
+CLIENT_QUEUE_SIZE = int(os.getenv("CLIENT_QUEUE_SIZE", 64))
+# Seconds a single send to a client may take before it is disconnected as too slow
+CLIENT_SEND_TIMEOUT = float(os.getenv("CLIENT_SEND_TIMEOUT", 5))
+# Loco and accessory states are journalled in STATE_DIR and reloaded at startup,
+# with changes written out every JOURNAL_SYNC_INTERVAL seconds (empty STATE_DIR disables)
+STATE_DIR = os.getenv("STATE_DIR", "/var/lib/xpressnet-control")
+JOURNAL_SYNC_INTERVAL = float(os.getenv("JOURNAL_SYNC_INTERVAL", 1))
+
 controller_lock = threading.Lock()
 controller = None
-connected_clients = set()
-accessory_states = {}  # Dictionary to store accessory states by accessoryID
+connected_clients = {}  # websocket -> Client
+subscriptions = {}  # Topic -> set of subscribed Clients
+unfiltered_clients = set()  # Clients without subscriptions, they receive every broadcast
+accessory_states = state.accessories  # Accessory states by accessoryID, changed through state.set_accessory
+
+# Metrics exported on the HTTP server's /metrics page
+broadcast_seconds = metrics.Histogram("websocket_broadcast_seconds", "Time spent fanning a message out to client queues.")
+slow_client_disconnects = metrics.Counter("websocket_slow_client_disconnects_total", "Clients disconnected for being too slow.")
+metrics.Gauge("websocket_connected_clients", "Connected WebSocket clients.", lambda: len(connected_clients))
+
+# The server's single asyncio loop and the queue feeding its broadcast task.
+# Other threads (serial reader, availability check, HTTP) only hand work to it.
+event_loop = None
+event_queue = None
+broadcast_task = None  # Held here, the loop only keeps a weak reference to tasks
+
+# Address ranges such as "1-99,200" as a list of (low, high)
+def parse_ranges(text):
+    ranges = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        low, _, high = part.partition("-")
+        ranges.append((int(low), int(high or low)))
+    return ranges
+
+# Settings of each command station, from STATIONS or the single SERIAL_DEVICE
+def station_settings():
+    if not STATIONS:
+        return [{"name": None, "device": SERIAL_DEVICE, "baud": SERIAL_BAUD, "delay": COMMAND_DELAY,
+                 "locos": [], "accessories": []}]
+    settings = []
+    for name in STATIONS:
+        prefix = f"STATION_{name.upper()}_"
+        device = os.getenv(prefix + "DEVICE")
+        if not device:
+            raise ValueError(f"{prefix}DEVICE is not set")
+        settings.append({
+            "name": name,
+            "device": device,
+            "baud": int(os.getenv(prefix + "BAUD", SERIAL_BAUD)),
+            "delay": float(os.getenv(prefix + "COMMAND_DELAY", COMMAND_DELAY)),
+            "locos": parse_ranges(os.getenv(prefix + "LOCOS", "")),
+            "accessories": parse_ranges(os.getenv(prefix + "ACCESSORIES", "")),
+        })
+    return settings
 
 class XpressNetController:
-    def __init__(self, device_path, baud_rate, message_delay, response_handler):
+    def __init__(self, stations, response_handler, optimistic_state=True, health_probe_interval=health.PROBE_INTERVAL):
         try:
-            xpressNet.connection_open(device_path, baud_rate, message_delay, response_handler)
-            self.trains = {}
+            self.optimistic_state = optimistic_state
             self.accessories = {}
+            self.last_used = {}  # Train number -> monotonic time of the last command
+            self.connections = []  # One xpressNet.Connection per command station, the first is the default route
+            self.loco_routes = []  # (low, high, connection)
+            self.accessory_routes = []
+            self.health = {}  # Connection -> health.HealthMonitor
+            for station in stations:
+                connection = xpressNet.Connection(station["device"], station["baud"], station["delay"],
+                                                  response_handler, station["name"])
+                connection.frame_sink = station.get("frame_sink")
+                connection.open()
+                self.connections.append(connection)
+                self.loco_routes.extend((low, high, connection) for low, high in station["locos"])
+                self.accessory_routes.extend((low, high, connection) for low, high in station["accessories"])
+                self.health[connection] = health.HealthMonitor(connection, health_probe_interval)
+                self.health[connection].start()
         except ImportError:
             raise ImportError("xpressNet library not installed. Please install it to use the real controller.")
 
+    def station_for_loco(self, train_number):
+        for low, high, connection in self.loco_routes:
+            if low <= train_number <= high:
+                return connection
+        return self.connections[0]
+
+    def station_for_accessory(self, accessory_number):
+        for low, high, connection in self.accessory_routes:
+            if low <= accessory_number <= high:
+                return connection
+        return self.connections[0]
+
     def is_controller_connected(self):
-        """Check if the controller is connected."""
-        return xpressNet.is_controller_connected()
+        """Check if a command station is connected."""
+        return any(connection.is_controller_connected() for connection in self.connections)
+
+    def get_health(self):
+        """Cached controller health, never touches the serial port. With several
+        stations it is "degraded" while only some of them are online."""
+        if len(self.connections) == 1:
+            return self.health[self.connections[0]].status()
+        results = {connection.name: self.health[connection].status() for connection in self.connections}
+        online = sum(result["status"] == "online" for result in results.values())
+        if online == len(results):
+            status = "online"
+        elif online:
+            status = "degraded"
+        else:
+            status = "offline"
+        return {"status": status, "checked_at": max(result["checked_at"] for result in results.values()),
+                "stations": results}
+
+    def get_transmit_stats(self):
+        """Counters and current queue depth of the serial transmit scheduler,
+        summed over the stations when there are several."""
+        if len(self.connections) == 1:
+            return self.connections[0].get_transmit_stats()
+        stations = {connection.name: connection.get_transmit_stats() for connection in self.connections}
+        totals = {}
+        for stats in stations.values():
+            for key, value in stats.items():
+                totals[key] = max(totals.get(key, 0), value) if key == "delay" else totals.get(key, 0) + value
+        totals["stations"] = stations
+        return totals
 
     def getStatus(self):
-        xpressNet.getStatus()
+        for connection in self.connections:
+            if connection.is_controller_connected():
+                connection.getStatus()
 
     def getVersion(self):
-        xpressNet.getVersion()
+        for connection in self.connections:
+            if connection.is_controller_connected():
+                connection.getVersion()
 
     def emergencyOff(self):
-        xpressNet.emergencyOff()
+        self.send_to_every_station(xpressNet.Connection.emergencyOff)
 
     def resumeNormalOperations(self):
-        xpressNet.resumeNormalOperations()
+        self.send_to_every_station(xpressNet.Connection.resumeNormalOperations)
+
+    # A station that cannot take the command must not keep it from the others,
+    # so every station is tried and the failures are reported together
+    def send_to_every_station(self, send):
+        failures = []
+        for connection in self.connections:
+            try:
+                send(connection)
+            except Exception as e:
+                failures.append(f"{connection.name}: {e}" if connection.name else str(e))
+        if failures:
+            raise xpressNet.XpressNetException("; ".join(failures))
 
     def get_train(self, train_number):
-        if train_number not in self.trains:
-            self.trains[train_number] = xpressNet.Train(train_number)
-        return self.trains[train_number]
+        # Sends through the loco's station; decoders of every station update the same cached state
+        train = self.station_for_loco(train_number).get_train(train_number)
+        self.last_used[train_number] = time.monotonic()
+        return train
+
+    def report_state(self, train):
+        """Broadcast the train state after a command, optimistically or by asking the Elite."""
+        if self.optimistic_state:
+            train.connection.publish_train_state(train)
+        else:
+            train.getState()
 
     def throttle(self, train_number, speed, direction):
         train = self.get_train(train_number)
         train.throttle(speed, direction)
-        return train.getState()
+        return self.report_state(train)
 
     def stop(self, train_number):
         train = self.get_train(train_number)
         train.stop()
-        return train.getState()
+        return self.report_state(train)
 
     def function(self, train_number, function_id, switch):
         train = self.get_train(train_number)
         train.function(function_id, switch)
-        return train.getState()
+        return self.report_state(train)
 
     def getState(self, train_number):
         train = self.get_train(train_number)
         return train.getState()
 
+    def batch(self, commands):
+        """Validate a list of throttle, stop, function and accessory commands and,
+        if all are valid, queue their frames as one paced burst."""
+        if not isinstance(commands, list) or not commands:
+            return {"status_code": 400, "message": "Batch needs a list of commands"}
+        errors = [
+            {"index": index, "error": error}
+            for index, error in ((index, validate_command(command)) for index, command in enumerate(commands))
+            if error
+        ]
+        if errors:
+            return {"status_code": 400, "message": "Invalid batch, nothing was sent", "errors": errors}
+
+        # Frames are built without touching the state store, the state changes
+        # are only applied once every frame is queued
+        bursts = {}  # Connection -> frames for that command station
+        trains = {}
+        groups = {}  # Train number -> function group bytes as the batch leaves them
+        directions = {}  # Train number -> direction as the batch leaves it
+        updates = []  # (update function, arguments) in command order
+        for command in commands:
+            action = command['action']
+            if action == 'setAccessoryDirection':
+                output = 1 if command['direction'] == "FORWARD" else 2
+                accessory = self.get_accessory(command['accessory_number'])
+                bursts.setdefault(accessory.connection, []).append((accessory.output_frame(output), None))
+                continue
+            train = self.get_train(command['train_number'])
+            trains[train.address] = train
+            frames = bursts.setdefault(train.connection, [])
+            if action == 'throttle':
+                frames.append(train.throttle_frame(command['speed'], command['direction']))
+                directions[train.address] = command['direction']
+                updates.append((train.update_throttle, (command['speed'], command['direction'])))
+            elif action == 'stop':
+                direction = directions.get(train.address, train.direction)
+                frames.append(train.throttle_frame(0, direction))
+                updates.append((train.update_throttle, (0, direction)))
+            else:
+                if train.address not in groups:
+                    groups[train.address] = train.group
+                frames.append(train.function_frame(command['function_id'], command['switch'], groups[train.address]))
+                updates.append((train.update_function, (command['function_id'], command['switch'])))
+
+        # Every station must take its burst, or the batch would be sent in part. Their
+        # transmit queues are held (in station order) from the check until all are queued.
+        stations = [connection for connection in self.connections if connection in bursts]
+        sent = []
+        with ExitStack() as held:
+            for connection in stations:
+                held.enter_context(connection.transmit_condition)
+            for connection in stations:
+                if not connection.listening:
+                    return {"status_code": 503, "message": "Batch not sent: Connection not open"}
+                if connection.transmit_room() < len(bursts[connection]):
+                    return {"status_code": 503, "message": "Batch not sent: Transmit queue full"}
+            try:
+                for connection in stations:
+                    connection.send_burst(bursts[connection])
+                    sent.append(connection)
+            except xpressNet.XpressNetException as e:
+                if not sent:
+                    return {"status_code": 503, "message": f"Batch not sent: {e}"}
+                return {"status_code": 503, "message": f"Batch sent in part: {e}",
+                        "stations_sent": [connection.name for connection in sent]}
+        for update, arguments in updates:
+            update(*arguments)
+        for train in trains.values():
+            self.report_state(train)
+        return {"status_code": 200, "message": "Batch sent", "commands": len(commands),
+                "frames": sum(len(frames) for frames in bursts.values())}
+
     def setAccessoryDirection(self, accessory_number, direction):
         try:
             accessory = self.get_accessory(accessory_number)
@@ -84,23 +340,179 @@ class XpressNetController:
 
     def get_accessory(self, accessory_number):
         if accessory_number not in self.accessories:
-            self.accessories[accessory_number] = xpressNet.Accessory(accessory_number)
+            self.accessories[accessory_number] = self.station_for_accessory(accessory_number).get_accessory(accessory_number)
         return self.accessories[accessory_number]
 
-# Define a callback function to handle messages and forward them to all clients
-def response_handler(message):
-    asyncio.run(broadcast_message(json.loads(message)))
-
-def is_controller_available():
+def is_integer(value, low, high):
+    return isinstance(value, int) and not isinstance(value, bool) and low <= value <= high
+
+# Reason a batch command is invalid, or None if it can be sent
+def validate_command(command):
+    if not isinstance(command, dict):
+        return "Command is not an object"
+    action = command.get('action')
+    if action == 'setAccessoryDirection':
+        if not is_integer(command.get('accessory_number'), 0, 1023):
+            return "Invalid accessory_number"
+        if command.get('direction') not in ("FORWARD", "REVERSE"):
+            return "Invalid accessory direction"
+        return None
+    if action not in ('throttle', 'stop', 'function'):
+        return f"Unsupported batch action: {action}"
+    if not state.valid_address(command.get('train_number')):
+        return "Invalid train_number"
+    if action == 'throttle':
+        if not is_integer(command.get('speed'), 0, 127):
+            return "Invalid speed"
+        if command.get('direction') not in (xpressNet.FORWARD, xpressNet.REVERSE):
+            return "Invalid direction"
+    elif action == 'function':
+        if not is_integer(command.get('function_id'), 0, 28):
+            return "Invalid function_id"
+        if command.get('switch') not in (xpressNet.ON, xpressNet.OFF):
+            return "Invalid switch"
+    return None
+
+class Client:
+    """A connected WebSocket client with its own bounded outbound queue and writer task.
+
+    Messages with the same coalescing key (e.g. the state of one loco) replace
+    each other while queued, so a slow client only ever gets the newest state,
+    in the order the states were published.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.queue = deque()  # [key, message_json] entries in send order
+        self.pending = {}  # Coalescing key -> queued entry
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.topics = set()  # Subscribed topics, empty means everything
+        unfiltered_clients.add(self)
+        self.writer = asyncio.create_task(self.write_loop())
+
+    def subscribe(self, topics):
+        for topic in topics:
+            self.topics.add(topic)
+            subscriptions.setdefault(topic, set()).add(self)
+        if self.topics:
+            unfiltered_clients.discard(self)
+
+    def unsubscribe(self, topics):
+        for topic in topics:
+            self.topics.discard(topic)
+            subscribers = subscriptions.get(topic)
+            if subscribers is not None:
+                subscribers.discard(self)
+                if not subscribers:
+                    del subscriptions[topic]
+        if not self.topics:
+            unfiltered_clients.add(self)
+
+    def enqueue(self, message_json, key=None):
+        if self.closed:
+            return
+        if key is not None:
+            entry = self.pending.pop(key, None)
+            if entry is not None:
+                # Newest state wins and goes to the back, so it stays ordered
+                # after any other message queued since the one it replaces
+                self.queue.remove(entry)
+        if len(self.queue) >= CLIENT_QUEUE_SIZE:
+            self.disconnect("Client too slow")
+            return
+        entry = [key, message_json]
+        self.queue.append(entry)
+        if key is not None:
+            self.pending[key] = entry
+        self.ready.set()
+
+    async def write_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue:
+                    key, message_json = entry = self.queue.popleft()
+                    if key is not None and self.pending.get(key) is entry:
+                        del self.pending[key]
+                    await asyncio.wait_for(self.websocket.send(message_json), CLIENT_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.disconnect("Client too slow")
+        except websockets.ConnectionClosed:
+            pass
+
+    def disconnect(self, reason):
+        if not self.closed:
+            self.closed = True
+            slow_client_disconnects.inc()
+            print(f"Disconnecting client: {reason}")
+            asyncio.create_task(self.websocket.close(code=1008, reason=reason))
+
+    def stop(self):
+        self.closed = True
+        self.writer.cancel()
+        self.unsubscribe(list(self.topics))
+        unfiltered_clients.discard(self)
+
+# Topics a client can subscribe to from a subscribe/unsubscribe request
+def requested_topics(data):
+    topics = [("train", train_number) for train_number in data.get('train_numbers', [])]
+    topics += [("accessory", accessory_id) for accessory_id in data.get('accessory_ids', [])]
+    if data.get('status'):
+        topics.append(("status",))
+    return topics
+
+# Topic a broadcast belongs to: a loco, an accessory or the system status
+def message_topic(message):
+    if isinstance(message, xpressNet.Event):
+        train_number = message.data.get("train_number")
+        if train_number is not None:
+            return ("train", train_number)
+        return ("status",)
+    if message.get("message") == "accessoryState":
+        return ("accessory", message.get("accessory_id"))
+    return ("status",)
+
+# Key under which queued copies of a message replace each other (newest state wins,
+# per command station for station events)
+def coalesce_key(message, topic):
+    if isinstance(message, xpressNet.Event):
+        return (message.message, topic, message.data.get("Station"))
+    return (message.get("message"), topic)
+
+# Define a callback function to handle decoded xpressNet events and forward them to all clients.
+# Decoded events arrive on the serial reader thread and are queued on the server
+# loop thread-safely; optimistic loco states published by a command handler are
+# already on the loop and are queued directly, never through asyncio.run().
+def response_handler(event):
+    loop = event_loop
+    if loop is None:
+        return
     try:
-        xpressNet.connection_open('/dev/ttyACM0', 19200, 0.25, response_handler)
-        return True
-    except ImportError:
-        return False
-    except Exception as e:
-        return False
-
-# Function to get local IP address
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        event_queue.put_nowait(event)
+    else:
+        loop.call_soon_threadsafe(event_queue.put_nowait, event)
+
+# Run a coroutine function on the server loop from another thread (no-op until the loop runs)
+def run_in_event_loop(coroutine_function, *args):
+    loop = event_loop
+    if loop is not None:
+        asyncio.run_coroutine_threadsafe(coroutine_function(*args), loop)
+
+# Consumer task fanning queued events out to the clients
+async def broadcast_worker():
+    while True:
+        event = await event_queue.get()
+        try:
+            await broadcast_message(event)
+        except Exception as e:
+            print(f"Broadcast failed: {e}")
+
 def get_local_ip():
     """Get the local IP address of the machine."""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -117,147 +529,308 @@ def get_local_ip():
 # Function to send status updates to all connected clients
 async def send_status_update():
     controller_connected = False
+    transmit_queue_depth = 0
     if controller:
         controller_connected = controller.is_controller_connected()
+        transmit_queue_depth = controller.get_transmit_stats()["queue_depth"]
     response = {
         "status_code": 200,
         "message": "SocketStatus",
         "data": {
             "Ready": True,
             "Clients": len(connected_clients),
-            "Controller_Connected": controller_connected
+            "Controller_Connected": controller_connected,
+            "Transmit_Queue_Depth": transmit_queue_depth
         }
     }
     await broadcast_message(response)
     if controller_connected:
         controller.getStatus()
 
+# Layout state message for a client. A client that sends back the epoch and
+# sequence of the last state message it received gets a "stateDelta" with
+# only the locos and accessories changed since; anyone else gets the full
+# "stateSnapshot". Either way the reply carries the sequence to resync from.
+def state_message(sequence=None, epoch=None):
+    current = state.current_version()
+    try:
+        since = int(sequence)
+    except (TypeError, ValueError):
+        since = None
+    delta = since is not None and epoch == state.epoch and 0 <= since <= current
+
+    if delta:
+        addresses = state.changed_since(since)
+        accessories = state.accessories_changed_since(since)
+    else:
+        addresses = state.addresses()
+        accessories = state.accessories_changed_since(0)
+
+    return json.dumps({
+        "message": "stateDelta" if delta else "stateSnapshot",
+        "status_code": 200,
+        "data": {
+            "epoch": state.epoch,
+            "sequence": current,
+            "locos": [xpressNet.loco_state_event(address).data for address in addresses],
+            "accessories": accessories
+        }
+    })
+
+# WebSocket actions: action name -> (handler coroutine taking the Client and
+# the message, whether it needs a connected controller). Handlers never touch
+# the serial port: controller commands only queue frames for the transmit
+# thread and status comes from cached health, so they run directly on the loop.
+action_handlers = {}
+
+def action_handler(*actions, needs_controller=True):
+    def register(handler):
+        for action in actions:
+            action_handlers[action] = (handler, needs_controller)
+        return handler
+    return register
+
+@action_handler('subscribe', 'unsubscribe', needs_controller=False)
+async def handle_subscriptions(client, data):
+    topics = requested_topics(data)
+    if data['action'] == 'subscribe':
+        client.subscribe(topics)
+    else:
+        client.unsubscribe(topics)
+    client.enqueue(json.dumps({
+        "message": "subscriptions",
+        "status_code": 200,
+        "data": {
+            "train_numbers": [topic[1] for topic in client.topics if topic[0] == "train"],
+            "accessory_ids": [topic[1] for topic in client.topics if topic[0] == "accessory"],
+            "status": ("status",) in client.topics
+        }
+    }))
+
+@action_handler('resync', needs_controller=False)
+async def handle_resync(client, data):
+    client.enqueue(state_message(data.get('sequence'), data.get('epoch')))
+
+@action_handler('getControllerStatus', needs_controller=False)
+async def handle_get_controller_status(client, data):
+    await send_status_update()
+
+@action_handler('getControllerVersion')
+async def handle_get_controller_version(client, data):
+    controller.getVersion()
+
+@action_handler('emergencyOff')
+async def handle_emergency_off(client, data):
+    controller.emergencyOff()
+
+@action_handler('resumeNormalOperations')
+async def handle_resume_normal_operations(client, data):
+    controller.resumeNormalOperations()
+
+@action_handler('throttle')
+async def handle_throttle(client, data):
+    train_number = data['train_number']
+    speed = data['speed']
+    direction = data['direction']
+    logging.debug('Throttle: Train: %s | Speed: %s | Direction: %s', train_number, speed, direction)
+
+    controller.throttle(train_number, speed, direction)
+
+@action_handler('stop')
+async def handle_stop(client, data):
+    train_number = data['train_number']
+    logging.debug('Stop: Train: %s', train_number)
+
+    controller.stop(train_number)
+
+@action_handler('getState')
+async def handle_get_state(client, data):
+    train_number = data['train_number']
+    logging.debug('getState: Train: %s', train_number)
+
+    controller.getState(train_number)
+
+@action_handler('function')
+async def handle_function(client, data):
+    train_number = data['train_number']
+    function_id = data['function_id']
+    switch = data['switch']
+    logging.debug('Function: Train: %s | Function ID: %s | Switch: %s', train_number, function_id, switch)
+
+    controller.function(train_number, function_id, switch)
+
+@action_handler('batch')
+async def handle_batch(client, data):
+    commands = data.get('commands')
+    logging.debug('Batch: %s commands', len(commands) if isinstance(commands, list) else None)
+
+    # One acknowledgement for the whole batch, to the client that sent it
+    result = controller.batch(commands)
+    client.enqueue(json.dumps({
+        "message": "batch",
+        "status_code": result.pop("status_code"),
+        "id": data.get('id'),
+        "data": result
+    }))
+
+@action_handler('setAccessoryDirection')
+async def handle_set_accessory_direction(client, data):
+    accessory_number = data['accessory_number']
+    direction = data['direction']
+    logging.debug('Accessory: Accessory: %s | Direction: %s', accessory_number, direction)
+
+    controller.setAccessoryDirection(accessory_number, direction)
+
+@action_handler('setAccessoryState')
+async def handle_set_accessory_state(client, data):
+    accessory_id = data['accessory_id']
+    accessory_state = data['state']
+    logging.debug('Set Accessory State: Accessory ID: %s | State: %s', accessory_id, accessory_state)
+
+    await set_accessory_state(accessory_id, accessory_state)
+
+# Store an accessory state and broadcast it to all clients
+async def set_accessory_state(accessory_id, accessory_state):
+    state.set_accessory(accessory_id, accessory_state)
+    await broadcast_message({
+        "message": "accessoryState",
+        "status_code": 200,
+        "accessory_id": accessory_id,
+        "state": accessory_state
+    })
+
+@action_handler('getAccessoryState')
+async def handle_get_accessory_state(client, data):
+    accessory_id = data['accessory_id']
+    logging.debug('Get Accessory State: Accessory ID: %s', accessory_id)
+
+    # Answer only the client that asked
+    accessory_state = accessory_states.get(accessory_id, {})
+    client.enqueue(json.dumps({
+        "message": "accessoryState",
+        "status_code": 200,
+        "accessory_id": accessory_id,
+        "state": accessory_state
+    }))
+
+@action_handler('getAccessoryStates')
+async def handle_get_accessory_states(client, data):
+    logging.debug('Get Accessory States: %s', accessory_states)
+    client.enqueue(json.dumps({
+        "message": "accessoryStates",
+        "status_code": 200,
+        "accessories": accessory_states
+    }))
+
+@action_handler('controller_status', needs_controller=False)
+async def handle_controller_status(client, data):
+    # Answered from the cached health, "health" also tells an unresponsive Elite
+    # or, with several stations, a partly connected layout apart
+    result = controller.get_health() if controller else {"status": "offline", "checked_at": None}
+    response = {
+        'type': 'controller_status',
+        'status': 'online' if result['status'] in ('online', 'degraded') else 'offline',
+        'health': result['status'],
+        'checked_at': result['checked_at']
+    }
+    if 'stations' in result:
+        response['stations'] = {name: station['status'] for name, station in result['stations'].items()}
+    client.enqueue(json.dumps(response))
+
+def send_error(client, action, error):
+    client.enqueue(json.dumps({
+        "message": "error",
+        "status_code": 400,
+        "action": action,
+        "error": error
+    }))
+
 async def websocket_handler(websocket, path):
-    connected_clients.add(websocket)
+    client = Client(websocket)
+    connected_clients[websocket] = client
 
     # Send status update when a new client connects
     await send_status_update()
 
+    # Then the layout state: everything, or only what changed if the client
+    # reconnects with ?epoch=...&sequence=... from its last state message
+    query = parse_qs(urlparse(path).query)
+    client.enqueue(state_message(query.get('sequence', [None])[0], query.get('epoch', [None])[0]))
+
     try:
         async for message in websocket:
-            data = json.loads(message)
-            action = data.get('action')
-
-            if controller is None:
-                await send_status_update()
+            try:
+                data = json.loads(message)
+                action = data.get('action')
+            except (ValueError, AttributeError):
+                logging.debug('Ignoring malformed message: %s', message)
                 continue
 
-            # Check if the controller is connected
-            if not controller.is_controller_connected():
-                await send_status_update()
+            handler = action_handlers.get(action)
+            if handler is None:
+                logging.debug('Ignoring unknown action: %s', action)
                 continue
+            handler, needs_controller = handler
 
-            if action == 'getControllerStatus':
+            if needs_controller and (controller is None or not controller.is_controller_connected()):
                 await send_status_update()
                 continue
 
-            if action == 'getControllerVersion':
-                controller.getVersion()
-
-            if action == 'emergencyOff':
-                controller.emergencyOff()
-
-            if action == 'resumeNormalOperations':
-                controller.resumeNormalOperations()
-
-            if action == 'throttle':
-                train_number = data['train_number']
-                speed = data['speed']
-                direction = data['direction']
-                print(f'Throttle: Train: {train_number} | Speed: {speed} | Direction: {direction}')
-
-                controller.throttle(train_number, speed, direction)
-
-            elif action == 'stop':
-                train_number = data['train_number']
-                print(f'Stop: Train: {train_number}')
-
-                controller.stop(train_number)
-
-            elif action == 'getState':
-                train_number = data['train_number']
-                print(f'getState: Train: {train_number}')
-
-                controller.getState(train_number)
-
-            elif action == 'function':
-                train_number = data['train_number']
-                function_id = data['function_id']
-                switch = data['switch']
-                print(f'Function: Train: {train_number} | Function ID: {function_id} | Switch: {switch}')
-
-                controller.function(train_number, function_id, switch)
-
-            elif action == 'setAccessoryDirection':
-                accessory_number = data['accessory_number']
-                direction = data['direction']
-                print(f'Accessory: Accessory: {accessory_number} | Direction: {direction}')
-
-                controller.setAccessoryDirection(accessory_number, direction)
-
-            elif action == 'setAccessoryState':
-                accessory_id = data['accessory_id']
-                state = data['state']
-                print(f'Set Accessory State: Accessory ID: {accessory_id} | State: {state}')
-
-                # Store the state and broadcast to all clients
-                accessory_states[accessory_id] = state
-                await broadcast_message({
-                    "message": "accessoryState",
-                    "status_code": 200,
-                    "accessory_id": accessory_id,
-                    "state": state
-                })
-
-            elif action == 'getAccessoryState':
-                accessory_id = data['accessory_id']
-                print(f'Get Accessory State: Accessory ID: {accessory_id}')
-
-                state = accessory_states.get(accessory_id, {})
-                await broadcast_message({
-                    "message": "accessoryState",
-                    "status_code": 200,
-                    "accessory_id": accessory_id,
-                    "state": state
-                })
-
-            elif action == 'getAccessoryStates':
-                print('Get Accessory States')
-                print(accessory_states)
-                await broadcast_message({
-                    "message": "accessoryStates",
-                    "status_code": 200,
-                    "accessories": accessory_states
-                })
-
-            elif action == 'controller_status':
-                status = 'online' if is_controller_available() else 'offline'
-                await websocket.send(json.dumps({
-                    'type': 'controller_status',
-                    'status': status
-                }))
+            # A bad request is answered, it does not drop the connection
+            try:
+                await handler(client, data)
+            except KeyError as e:
+                send_error(client, action, f"Missing field: {e.args[0]}")
+            except Exception as e:
+                logging.warning('Action %s failed: %s', action, e)
+                send_error(client, action, str(e))
 
     except websockets.ConnectionClosed:
         print("Client disconnected")
     finally:
-        connected_clients.remove(websocket)
+        del connected_clients[websocket]
+        client.stop()
         # Send status update when a client disconnects
         await send_status_update()
 
-# Utility function to broadcast messages to all connected clients
+# Utility function to broadcast messages to the clients interested in them:
+# those subscribed to the message's topic and those without any subscription.
+# Accepts an xpressNet.Event (serialised once and cached) or a plain dict.
+# Messages are only queued per client; each client's writer task sends them,
+# so a slow client never holds up the others.
 async def broadcast_message(message):
-    if connected_clients:
+    started = time.perf_counter()
+    topic = message_topic(message)
+    subscribers = subscriptions.get(topic, ())
+    if not unfiltered_clients and not subscribers:
+        return
+    if isinstance(message, xpressNet.Event):
+        message_json = message.to_json()
+    else:
         message_json = json.dumps(message)
-        tasks = [asyncio.create_task(client.send(message_json)) for client in connected_clients]
-        await asyncio.gather(*tasks)
+    key = coalesce_key(message, topic)
+    for client in unfiltered_clients:
+        client.enqueue(message_json, key)
+    for client in subscribers:
+        client.enqueue(message_json, key)
+    broadcast_seconds.observe(time.perf_counter() - started)
+
+# Log why a background task stopped, its exception would otherwise go unseen
+def report_task_exit(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("%s stopped", task.get_name(), exc_info=task.exception())
 
 async def main():
-    async with websockets.serve(websocket_handler, "0.0.0.0", 8080):
+    global event_loop, event_queue, broadcast_task
+    event_queue = asyncio.Queue()
+    event_loop = asyncio.get_running_loop()
+    broadcast_task = asyncio.create_task(broadcast_worker(), name="Broadcast worker")
+    broadcast_task.add_done_callback(report_task_exit)
+    if HTTP_SERVER_ENABLE:
+        # Served on this loop, alongside the WebSocket server
+        await start_http_server(HTTP_SERVER_PORT, get_controller, get_local_ip(), WEBSOCKET_PORT,
+                                set_accessory_state, lambda: len(connected_clients))
+    async with websockets.serve(websocket_handler, "0.0.0.0", WEBSOCKET_PORT):
         print("WebSocket server started")
         await asyncio.Future()  # run forever
 
@@ -269,7 +842,6 @@ def set_controller(new_controller):
         controller = new_controller
 
 def get_controller():
-    global controller
     with controller_lock:
         return controller
 
@@ -283,7 +855,7 @@ def start_mdns_advertising():
         "_http._tcp.local.",
         "xpressNetControl._http._tcp.local.",
         addresses=[socket.inet_aton(local_ip)],
-        port=8080,
+        port=WEBSOCKET_PORT,
         properties=desc,
         server=f"{hostname}.local.",
     )
@@ -293,12 +865,15 @@ def start_mdns_advertising():
     zeroconf.register_service(info)
     print(f"mDNS service registered: xpressNetControl on {local_ip} ({hostname}.local)")
 
-def controller_availability_check():
-    global controller
+# Train numbers at least one client is subscribed to
+def watched_trains():
+    return [topic[1] for topic, clients in list(subscriptions.items()) if topic[0] == "train" and clients]
+
+def controller_availability_check(station_config):
     # Call set_controller once at the start
     if get_controller() is None:
         print("Setting up controller...")
-        set_controller(XpressNetController('/dev/ttyACM0', 19200, 0.25, response_handler))
+        set_controller(XpressNetController(station_config, response_handler, OPTIMISTIC_STATE, HEALTH_PROBE_INTERVAL))
 
     was_connected = False  # Tracks the previous connection state
 
@@ -313,23 +888,38 @@ def controller_availability_check():
                 print("Controller is disconnected!")
             was_connected = False  # Update the state
             # Handle disconnection logic if needed, e.g., send a status update
-            asyncio.run(send_status_update())
+            run_in_event_loop(send_status_update)
 
         time.sleep(10)  # Check every 10 seconds
 
 if __name__ == '__main__':
-    # Start mDNS/Bonjour advertising
-    start_mdns_advertising()
+    xpressNet.set_trace_sample_rate(TRACE_SAMPLE_RATE)
+    station_config = station_settings()
+    if FRAME_CAPTURE_FILE and len(station_config) == 1:
+        xpressNet.set_frame_sink(capture.open_capture_writer(FRAME_CAPTURE_FILE, FRAME_CAPTURE_FORMAT))
+    elif FRAME_CAPTURE_FILE:
+        # One capture per station, so each one can be replayed on its own
+        for station in station_config:
+            station["frame_sink"] = capture.open_capture_writer(f"{FRAME_CAPTURE_FILE}.{station['name']}",
+                                                                FRAME_CAPTURE_FORMAT)
+
+    if STATE_DIR:
+        try:
+            state_journal = journal.StateJournal(STATE_DIR, JOURNAL_SYNC_INTERVAL)
+            print(f"Loaded {state_journal.load()} records from the state journal")
+            state_journal.start()
+        except OSError as e:
+            print(f"State journal disabled: {e}")
 
-        # Check if HTTP server is enabled in the config
-    if os.getenv("HTTP_SERVER_ENABLE", "FALSE").upper() == "TRUE":
-        # Start HTTP server in a separate thread
-        http_server_thread = threading.Thread(target=start_http_server, args=(get_controller, get_local_ip()))
-        http_server_thread.daemon = True
-        http_server_thread.start()
+    # Start mDNS/Bonjour advertising
+    if MDNS_ENABLE:
+        start_mdns_advertising()
 
-    availability_check_thread = threading.Thread(target=controller_availability_check)
+    availability_check_thread = threading.Thread(target=controller_availability_check, args=(station_config,))
     availability_check_thread.daemon = True
     availability_check_thread.start()
 
+    if STATE_REFRESH_INTERVAL > 0 and STATE_REFRESH_SHARE > 0:
+        reconcile.StateReconciler(get_controller, watched_trains, STATE_REFRESH_INTERVAL, STATE_REFRESH_SHARE).start()
+
     asyncio.run(main())
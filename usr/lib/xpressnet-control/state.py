@@ -0,0 +1,129 @@
+import os
+import threading
+from array import array
+
+# Loco state shared by the decoder and the server, indexed by DCC address.
+# Speed/direction and the five function group bytes live in preallocated
+# arrays. Every change bumps a global version number and stamps the address
+# with it, so callers can ask what changed since a version they have seen.
+# Accessory states set by clients share the same version sequence. Versions
+# restart with each epoch, so a version is only meaningful with its epoch.
+
+MAX_ADDRESS = 9999
+GROUPS = 5  # F0-F4, F5-F8, F9-F12, F13-F20, F21-F28
+
+speed_direction = bytearray(b'\x80' * (MAX_ADDRESS + 1))  # Elite speed byte: bit 7 forward, bits 0-6 speed
+groups = bytearray((MAX_ADDRESS + 1) * GROUPS)
+versions = array('Q', bytes(8 * (MAX_ADDRESS + 1)))  # Version of the last change, 0 = never seen
+known = []  # Addresses seen so far, in first-seen order
+accessories = {}  # Accessory id -> state set by clients
+accessory_versions = {}  # Accessory id -> version of the last change
+
+epoch = os.urandom(4).hex()
+version = 0
+lock = threading.Lock()
+
+# Optional sink called with ("loco", address) or ("accessory", id) on every
+# change, while the lock is held, so it must be quick (the journal only marks it)
+change_sink = None
+
+def set_change_sink(sink):
+    global change_sink
+    change_sink = sink
+
+def valid_address(address):
+    return isinstance(address, int) and 1 <= address <= MAX_ADDRESS
+
+# Stamp an address as changed (caller holds lock)
+def touch(address):
+    global version
+    if not versions[address]:
+        known.append(address)
+    version += 1
+    versions[address] = version
+    if change_sink is not None:
+        change_sink("loco", address)
+
+# Make an address part of the state without changing it
+def register(address):
+    with lock:
+        if not versions[address]:
+            touch(address)
+
+def get_version(address):
+    return versions[address]
+
+def get_speed_direction(address):
+    return speed_direction[address]
+
+def get_groups(address):
+    start = address * GROUPS
+    return groups[start:start + GROUPS]
+
+def get_group(address, index):
+    return groups[address * GROUPS + index]
+
+def set_speed_direction(address, value):
+    with lock:
+        if speed_direction[address] != value or not versions[address]:
+            speed_direction[address] = value
+            touch(address)
+
+# Write some of an address's group bytes, starting at group index first
+def set_groups(address, first, values):
+    start = address * GROUPS + first
+    with lock:
+        if groups[start:start + len(values)] != bytes(values) or not versions[address]:
+            groups[start:start + len(values)] = bytes(values)
+            touch(address)
+
+# Switch bits of one group byte on or off and return the new byte
+def update_group(address, index, bitmask, on):
+    position = address * GROUPS + index
+    with lock:
+        value = groups[position] | bitmask if on else groups[position] & ~bitmask & 0xFF
+        if value != groups[position] or not versions[address]:
+            groups[position] = value
+            touch(address)
+        return value
+
+def set_accessory(accessory_id, value):
+    global version
+    with lock:
+        version += 1
+        accessories[accessory_id] = value
+        accessory_versions[accessory_id] = version
+        if change_sink is not None:
+            change_sink("accessory", accessory_id)
+
+def current_version():
+    return version
+
+def addresses():
+    with lock:
+        return list(known)
+
+# Addresses changed after the given version, oldest change first
+def changed_since(since):
+    with lock:
+        changed = [address for address in known if versions[address] > since]
+    changed.sort(key=versions.__getitem__)
+    return changed
+
+# Accessory states changed after the given version
+def accessories_changed_since(since):
+    with lock:
+        return {accessory_id: accessories[accessory_id]
+                for accessory_id, changed in accessory_versions.items() if changed > since}
+
+def clear():
+    global version, epoch
+    with lock:
+        speed_direction[:] = b'\x80' * (MAX_ADDRESS + 1)
+        groups[:] = bytes(len(groups))
+        versions[:] = array('Q', bytes(8 * (MAX_ADDRESS + 1)))
+        known.clear()
+        accessories.clear()
+        accessory_versions.clear()
+        epoch = os.urandom(4).hex()
+        version = 0
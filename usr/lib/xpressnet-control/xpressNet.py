@@ -1,10 +1,16 @@
 import logging
+import random
 import serial
 import threading
 import struct
+from collections import deque
+from concurrent.futures import Future
 from functools import reduce
 import json
 import time
+import metrics
+import state
+from hotplug import HotplugWatcher
 
 # Constants for direction
 REVERSE = 0
@@ -12,154 +18,742 @@ FORWARD = 1
 OFF = 0
 ON = 1
 
-# Global variables for serial communication
-ser = None
-lock = threading.Lock()
-buffer = bytearray()
-delay_between_commands = 0.25  # Default delay in seconds between commands
-listening = True  # Flag to control the listening thread
-
-connection_device = None
-connection_baud = None
-connection_delay = None
-callback = None
-
-controller_connected = False
-
-# Callback for processed messages
-callback = None
+# Each command station is driven through its own Connection, which owns the
+# serial port, the receive buffer, the transmit queue, the in-flight requests
+# and the supervisor thread. Loco and accessory states live in the shared
+# state store, so a layout split across several command stations is one set
+# of addresses; the caller routes each address to the station that drives it.
+COMPACT_THRESHOLD = 4096  # Consumed bytes kept in buffer before they are dropped
+DEFAULT_BAUD = 19200
+DEFAULT_DELAY = 0.25  # Default delay in seconds between commands
+
+# Transmit scheduler. send() only queues frames; a single transmit thread per
+# connection writes them to the Elite, keeping at least delay_between_commands
+# between frames and backing off when the Elite answers "busy" or
+# "transmission error".
+TRANSMIT_QUEUE_SIZE = 64  # Maximum number of frames waiting to be sent
+MIN_BACKOFF_DELAY = 0.05  # Smallest gap used once the Elite has rejected a frame
+MAX_BACKOFF_DELAY = 2.0  # Upper bound for the adaptive inter-frame gap
+BACKOFF_DECAY = 0.75  # Gap multiplier applied after each accepted frame
+MAX_RETRIES = 3  # Times a rejected frame is retransmitted before it is dropped
+REPLY_TIMEOUT = 0.5  # Longest wait for the Elite to answer a frame before sending the next
+
+# In-flight requests. Some replies (0xE4/0xE3 loco state) carry no address, so
+# each request is recorded, in transmit order, with the reply headers it expects.
+# A reply is credited to the oldest outstanding request expecting its header.
+REQUEST_TIMEOUT = 2.0  # Seconds to wait for a reply once a request is written
+
+# Connection supervisor. One thread per connection owns the serial port: it
+# opens it, runs the reader on it until the link fails, then backs off
+# (exponentially, with jitter) before the next attempt. The backoff is cut
+# short as soon as the device node reappears. Queued frames and the state
+# store are kept across disconnections, so operation picks up where it left off.
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+CONNECTED = "connected"
+BACKOFF = "backoff"
+MIN_RECONNECT_DELAY = 0.1  # Seconds before the first retry
+MAX_RECONNECT_DELAY = 5.0
+
+connections = []  # Every opened Connection, for the metrics
 
 function_table = []
 
-# Global dictionary to store active Train instances
-train_instances = {}
-
-# Global variable to store the last requested train state address
-last_requested_train_address = None
-
-# Global variable to track if the first response has been processed
-first_response_processed = False
-
-# Listen for incoming serial data
-def listen_serial():
-    global listening
-    while listening:
-        try:
-            receive()
-        except Exception as e:
-            logging.error(f"Error in listen_serial: {e}")
-            time.sleep(5)  # Wait before retrying to avoid spamming logs
-
-# Connection management
-def connection_open(device, baud, delay, cb=None):
-    global ser, delay_between_commands, callback, listening, controller_connected
-    global connection_device, connection_baud, connection_delay, callback  # Store the parameters globally
-
-    # Store connection parameters for reuse
-    connection_device = device
-    connection_baud = baud
-    connection_delay = delay
-    callback = cb
-
-    try:
-        ser = serial.Serial(device, baud)
-        ser.timeout = 1.0  # 1-second timeout for reads
-        delay_between_commands = delay
-        callback = cb  # Set the callback function
-        listening = True
-        generate_function_table()
-
-        print("Controller connected")
-        controller_connected = True
-
-        listen_thread = threading.Thread(target=listen_serial)
-        listen_thread.daemon = True
-        listen_thread.start()
-    except Exception as e:
-        logging.warning(f"Failed to open serial connection: {e}")
-        handle_disconnection()
-
-def connection_close():
-    global ser, listening, controller_connected
-    logging.debug("Closing serial connection")
-    listening = False  # Signal the thread to stop
-    controller_connected = False
-    if ser and ser.is_open:
-        ser.close()
-        ser = None
-
-def handle_disconnection():
-    global ser, listening, controller_connected, callback
-    if controller_connected:
-        controller_connected = False
-        print("Controller disconnected")
-
-    logging.info("Handling disconnection...")
-
-    if ser:
+# Hot-path logging. Frame hex dumps are only built when they will be used:
+# at DEBUG level, for a random sample of frames in trace mode, or for the
+# optional raw frame capture sink, which is called with (direction, data)
+# for every frame sent ("tx") and every chunk received ("rx"). A connection
+# with a frame_sink of its own uses that one instead.
+root_logger = logging.getLogger()
+trace_sample_rate = 0.0  # Fraction of frames logged at INFO level, 0 disables tracing
+frame_sink = None
+
+def set_trace_sample_rate(rate):
+    global trace_sample_rate
+    trace_sample_rate = rate
+
+def set_frame_sink(sink):
+    global frame_sink
+    frame_sink = sink
+
+def trace_frame(label, data):
+    if root_logger.isEnabledFor(logging.DEBUG):
+        logging.debug("%s: %s", label, to_hex(data))
+    elif trace_sample_rate and random.random() < trace_sample_rate:
+        logging.info("%s (sampled): %s", label, to_hex(data))
+
+# Metrics exported on the HTTP server's /metrics page, totals over all connections
+FRAME_TYPES = [f"{header_byte:02X}" for header_byte in range(256)]  # Header byte -> label
+frames_sent = metrics.Counter("xpressnet_frames_sent_total", "Frames written to the Elite, by header byte.", "type")
+frames_received = metrics.Counter("xpressnet_frames_received_total", "Frames received from the Elite, by header byte.", "type")
+bytes_sent = metrics.Counter("xpressnet_bytes_sent_total", "Bytes written to the serial port.")
+bytes_received = metrics.Counter("xpressnet_bytes_received_total", "Bytes read from the serial port.")
+frames_rejected = metrics.Counter("xpressnet_frames_rejected_total", "Frames rejected by the Elite, by reason.", "reason")
+transmit_wait_seconds = metrics.Histogram("xpressnet_transmit_wait_seconds", "Time frames spent in the transmit queue.")
+decode_seconds = metrics.Histogram("xpressnet_decode_seconds", "Time spent decoding each batch of received bytes.")
+reconnects = metrics.Counter("xpressnet_reconnects_total", "Reconnections to the Elite after the link was lost.")
+disconnected_seconds = metrics.Counter("xpressnet_disconnected_seconds_total", "Time spent without a link to the Elite, for past outages.")
+metrics.Gauge("xpressnet_controller_connected", "Command stations currently connected.",
+              lambda: sum(connection.controller_connected for connection in list(connections)))
+metrics.Gauge("xpressnet_transmit_queue_depth", "Frames waiting to be sent.",
+              lambda: sum(len(connection.transmit_queue) for connection in list(connections)))
+metrics.Gauge("xpressnet_inflight_requests", "Requests waiting for a reply from the Elite.",
+              lambda: sum(len(connection.inflight_requests) for connection in list(connections)))
+
+# Seconds to wait before reconnect attempt number attempt (1 for the first)
+def reconnect_delay(attempt):
+    delay = min(MAX_RECONNECT_DELAY, MIN_RECONNECT_DELAY * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+# A link to one command station
+class Connection:
+    def __init__(self, device, baud=DEFAULT_BAUD, delay=DEFAULT_DELAY, callback=None, name=None):
+        self.device = device
+        self.baud = baud
+        self.delay_between_commands = delay
+        self.callback = callback  # Called with every decoded Event
+        self.name = name  # Station name reported with status events, None for a single station
+        self.label = f"Controller {name}" if name else "Controller"
+        self.frame_sink = None
+
+        # Serial port and receive buffer
+        self.ser = None
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.read_offset = 0  # Position of the next undecoded byte in buffer
+        self.listening = False  # True while the supervisor should keep the link up
+
+        # Transmit scheduler
+        self.transmit_queue = deque()
+        self.pending_frames = {}  # Coalescing key -> queued Frame that has not been written yet
+        self.transmit_condition = threading.Condition()
+        self.transmit_thread = None
+        self.transmit_delay = delay  # Current (adaptive) gap between frames
+        self.next_transmit_time = 0.0
+        self.last_transmitted = None  # Frame the next busy/error reply refers to
+        self.awaiting_reply_until = 0.0  # The next frame waits for a reply to the last one, or this time
+        self.transmit_stats = {
+            "sent": 0,
+            "busy": 0,
+            "transmission_errors": 0,
+            "retries": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "timeouts": 0,
+        }
+        self.inflight_requests = deque()
+        self.readback_versions = {}  # Address -> loco version left by the last read-back reply applied
+
+        # Supervisor and liveness
+        self.controller_connected = False
+        self.connection_state = DISCONNECTED
+        self.supervisor_thread = None
+        self.disconnected_since = None  # Monotonic time the link was lost, None while connected
+        self.last_received = None  # Monotonic time bytes last arrived from the Elite, for liveness
+        self.last_status_byte = None  # Last command station status reported, to spot changes
+
+    # Starts the supervisor, which connects in the background
+    def open(self):
+        if self not in connections:
+            connections.append(self)
+        self.start_transmitter()
+
+        self.listening = True
+        if self.supervisor_thread is None or not self.supervisor_thread.is_alive():
+            self.supervisor_thread = threading.Thread(target=self.supervise)
+            self.supervisor_thread.daemon = True
+            self.supervisor_thread.start()
+
+    def close(self):
+        logging.debug("Closing serial connection to %s", self.device)
+        self.listening = False  # Signal the supervisor to stop
+        self.close_port()
+
+    def set_connection_state(self, new_state):
+        if new_state != self.connection_state:
+            logging.debug("Connection %s %s -> %s", self.device, self.connection_state, new_state)
+            self.connection_state = new_state
+
+    def supervise(self):
+        watcher = HotplugWatcher(self.device)
+        attempt = 0
         try:
-            ser.close()
-        except Exception as e:
-            logging.error(f"Error closing serial port: {e}")
-        ser = None
-
-    # Retry connection in a loop
-    while True:
-        try:
-            time.sleep(5)  # Wait before retrying
-            print("Trying to reconnect")
-            if connection_device and connection_baud and connection_delay is not None:
-                logging.info("Retrying connection...")
-                connection_open(connection_device, connection_baud, connection_delay, callback)
-                logging.info("Reconnected successfully")
-                break
-            else:
-                logging.error("Missing connection parameters, cannot reconnect")
-                break
-        except Exception as e:
-            logging.error(f"Failed to reconnect: {e}")
-            time.sleep(5)  # Wait before retrying
-
-# New method to get the connection status
-def is_controller_connected():
-    global controller_connected
-    return controller_connected
-
-# Send data over serial
-def send(data):
-    global ser
-    if ser is None:
-        raise XpressNetException("Connection not open")
-    buffer = bytearray(data)
-    checksum = calculate_checksum(buffer)
-    buffer.append(checksum)
-    with lock:
-        logging.debug(f"Sending: {to_hex(buffer)}")
-        ser.write(buffer)
-
-# Receive data and process buffer
-def receive():
-    global ser, listening, buffer
-    while listening:
-        try:
-            with lock:
-                if ser.in_waiting > 0:
-                    data = ser.read(ser.in_waiting)  # Read all available bytes
-                    logging.debug(f"Received: {to_hex(data)}")
-                    buffer.extend(data)  # Add to the buffer
-                    process_data()  # Process the buffer
-        except serial.SerialException as e:
-            logging.error(f"Serial exception during reception: {e}")
-            listening = False
-            handle_disconnection()
-        except OSError as e:
-            logging.error(f"OSError during reception: {e}")
-            listening = False
-            handle_disconnection()
-        except Exception as e:
-            logging.error(f"Unexpected exception during reception: {e}")
-            listening = False
-            handle_disconnection()
+            while self.listening:
+                self.set_connection_state(CONNECTING)
+                try:
+                    self.open_port()
+                except (serial.SerialException, OSError) as e:
+                    attempt += 1
+                    delay = reconnect_delay(attempt)
+                    if attempt == 1:
+                        logging.warning("Failed to open serial connection: %s", e)
+                    else:
+                        logging.debug("Reconnect attempt %s failed: %s", attempt, e)
+                    self.set_connection_state(BACKOFF)
+                    if watcher.wait(delay):
+                        logging.debug("%s changed, reconnecting", self.device)
+                    continue
+
+                attempt = 0
+                self.set_connection_state(CONNECTED)
+                try:
+                    self.receive()
+                except Exception as e:
+                    logging.error("Serial connection to %s lost: %s", self.device, e)
+                self.port_lost()
+        finally:
+            watcher.close()
+            self.set_connection_state(DISCONNECTED)
+
+    def open_port(self):
+        port = serial.Serial(self.device, self.baud)
+        port.timeout = 1.0  # 1-second timeout for reads
+        with self.transmit_condition:
+            self.ser = port
+            self.transmit_condition.notify()  # Frames queued while disconnected can go now
+
+        print(f"{self.label} connected")
+        self.controller_connected = True
+        if self.disconnected_since is not None:
+            reconnects.inc()
+            disconnected_seconds.inc(time.monotonic() - self.disconnected_since)
+            self.disconnected_since = None
+
+    def close_port(self):
+        self.controller_connected = False
+        with self.transmit_condition:
+            port, self.ser = self.ser, None
+        if port is not None:
+            try:
+                port.close()
+            except Exception as e:
+                logging.error("Error closing serial port: %s", e)
+
+    def port_lost(self):
+        if self.controller_connected:
+            print(f"{self.label} disconnected")
+        if self.disconnected_since is None:
+            self.disconnected_since = time.monotonic()
+        self.close_port()
+
+        # Replies to requests already written will not arrive, and partial frames are stale
+        self.fail_requests("Controller disconnected")
+        self.buffer.clear()
+        self.read_offset = 0
+
+    def is_controller_connected(self):
+        return self.controller_connected
+
+    # Queue data to be sent over serial by the transmit thread.
+    # Frames sent with the same key (e.g. loco address and frame kind) coalesce:
+    # if one is still waiting in the queue it is replaced by the newer data, so
+    # superseded speeds or function states are never transmitted.
+    # Frames that expect a reply (expects = tuple of reply header bytes) return a
+    # Future that resolves with the decoded reply. Quiet requests only report
+    # their reply through the callback if it changed the cached state.
+    # Priority frames (emergency off, resume) jump the queue: they go ahead of
+    # everything but earlier priority frames, are never refused for a full
+    # queue and are written without waiting for the inter-frame gap.
+    def send(self, data, key=None, expects=None, address=None, quiet=False, priority=False):
+        # Frames queued while the link is down are sent once it is back
+        if not self.listening:
+            raise XpressNetException("Connection not open")
+        buffer = bytearray(data)
+        checksum = calculate_checksum(buffer)
+        buffer.append(checksum)
+        request = None
+        if expects is not None:
+            request = Request(expects, address, quiet)
+            if address is not None:
+                request.version = state.get_version(address)
+        with self.transmit_condition:
+            if priority:
+                frame = Frame(buffer)
+                frame.priority = True
+                frame.queued_at = time.monotonic()
+                self.insert_after_priority(frame)
+                self.transmit_condition.notify()
+                return
+            if key is not None and request is None and self.coalesce_frame(buffer, key):
+                return
+            if len(self.transmit_queue) >= TRANSMIT_QUEUE_SIZE:
+                self.transmit_stats["dropped"] += 1
+                raise XpressNetException("Transmit queue full")
+            self.queue_frame(buffer, key, request)
+            self.transmit_condition.notify()
+        if request is not None:
+            return request.future
+
+    # Queue several (data, key) frames back to back, all or none. The transmitter
+    # still paces them, but nothing queued afterwards can get in between. A queued
+    # frame with the same key as one in the burst is dropped rather than coalesced,
+    # so every frame of the burst goes out inside it.
+    def send_burst(self, frames):
+        if not self.listening:
+            raise XpressNetException("Connection not open")
+        buffers = []
+        for data, key in frames:
+            buffer = bytearray(data)
+            buffer.append(calculate_checksum(buffer))
+            buffers.append((buffer, key))
+        with self.transmit_condition:
+            if len(self.transmit_queue) + len(buffers) > TRANSMIT_QUEUE_SIZE:
+                self.transmit_stats["dropped"] += len(buffers)
+                raise XpressNetException("Transmit queue full")
+            for buffer, key in buffers:
+                if key is not None:
+                    self.drop_pending(key)
+                self.queue_frame(buffer, key)
+            self.transmit_condition.notify()
+
+    # Frames that can still be queued before the transmit queue is full
+    def transmit_room(self):
+        with self.transmit_condition:
+            return TRANSMIT_QUEUE_SIZE - len(self.transmit_queue)
+
+    # Replace the data of a queued frame with the same key (caller holds transmit_condition)
+    def coalesce_frame(self, buffer, key):
+        pending = self.pending_frames.get(key)
+        if pending is None:
+            return False
+        pending.data = buffer
+        pending.retries = 0
+        self.transmit_stats["coalesced"] += 1
+        return True
+
+    # Remove a queued frame superseded by a newer one with the same key (caller holds transmit_condition)
+    def drop_pending(self, key):
+        pending = self.pending_frames.pop(key, None)
+        if pending is not None:
+            self.transmit_queue.remove(pending)
+            self.transmit_stats["coalesced"] += 1
+
+    # Append a frame to the transmit queue (caller holds transmit_condition)
+    def queue_frame(self, buffer, key, request=None):
+        frame = Frame(buffer, key, request)
+        frame.queued_at = time.monotonic()
+        self.transmit_queue.append(frame)
+        if key is not None and request is None:
+            self.pending_frames[key] = frame
+
+    def start_transmitter(self):
+        if self.transmit_thread is None or not self.transmit_thread.is_alive():
+            self.transmit_thread = threading.Thread(target=self.transmit)
+            self.transmit_thread.daemon = True
+            self.transmit_thread.start()
+
+    # Write queued frames to the serial port, paced by transmit_delay
+    def transmit(self):
+        while True:
+            with self.transmit_condition:
+                if not self.transmit_queue or self.ser is None:
+                    self.transmit_condition.wait(0.5)
+                    continue
+                # Wait for the Elite to answer the last frame, so a busy reply is
+                # credited to the right frame, and for the inter-frame gap.
+                # Priority frames do not wait.
+                wait = max(self.next_transmit_time, self.awaiting_reply_until) - time.monotonic()
+                if wait > 0 and not self.transmit_queue[0].priority:
+                    # Re-check after waiting, a rejected frame may have been put back in front
+                    self.transmit_condition.wait(wait)
+                    continue
+                frame = self.transmit_queue.popleft()
+                if frame.key is not None and frame.request is None:
+                    del self.pending_frames[frame.key]
+                if frame.request is not None:
+                    # Registered before writing so a fast reply always finds it
+                    frame.request.deadline = time.monotonic() + REQUEST_TIMEOUT
+                    self.inflight_requests.append(frame.request)
+                port = self.ser
+
+            try:
+                transmit_wait_seconds.observe(time.monotonic() - frame.queued_at)
+                with self.lock:
+                    port.write(frame.data)
+                frames_sent.inc(label=FRAME_TYPES[frame.data[0]])
+                bytes_sent.inc(len(frame.data))
+                sink = self.frame_sink or frame_sink
+                if sink is not None:
+                    sink("tx", frame.data)
+                trace_frame("Sending", frame.data)
+            except Exception as e:
+                # Keep the frame, the reader thread will notice the disconnection. A request
+                # already failed by port_lost() is not sent again, its caller has the error.
+                logging.error("Error writing to serial port: %s", e)
+                with self.transmit_condition:
+                    if frame.request is not None and frame.request in self.inflight_requests:
+                        self.inflight_requests.remove(frame.request)
+                    if frame.request is None or not frame.request.future.done():
+                        self.requeue_frame(frame)
+                    self.next_transmit_time = time.monotonic() + 0.5
+                continue
+
+            with self.transmit_condition:
+                self.transmit_stats["sent"] += 1
+                self.last_transmitted = frame
+                self.awaiting_reply_until = time.monotonic() + REPLY_TIMEOUT
+                # Ease back towards the configured gap while the Elite keeps accepting frames
+                self.transmit_delay = max(self.delay_between_commands, self.transmit_delay * BACKOFF_DECAY)
+                self.next_transmit_time = time.monotonic() + self.transmit_delay
+
+    # Called when the Elite rejects the last frame (busy or transmission error)
+    def frame_rejected(self, reason):
+        frames_rejected.inc(label=reason)
+        with self.transmit_condition:
+            self.transmit_stats[reason] += 1
+            self.transmit_delay = min(max(self.transmit_delay, self.delay_between_commands, MIN_BACKOFF_DELAY) * 2,
+                                      MAX_BACKOFF_DELAY)
+            self.next_transmit_time = time.monotonic() + self.transmit_delay
+            frame = self.last_transmitted
+            self.last_transmitted = None
+            if frame is not None:
+                if frame.request is not None and frame.request in self.inflight_requests:
+                    # The rejected request is registered again when it is rewritten
+                    self.inflight_requests.remove(frame.request)
+                if frame.key is not None and frame.key in self.pending_frames:
+                    # A newer frame of the same kind is already queued, let that one go instead
+                    self.transmit_stats["coalesced"] += 1
+                elif frame.retries < MAX_RETRIES:
+                    frame.retries += 1
+                    self.transmit_stats["retries"] += 1
+                    self.requeue_frame(frame)
+                else:
+                    self.transmit_stats["dropped"] += 1
+                    logging.warning("Dropping frame after %d retries: %s", MAX_RETRIES, to_hex(frame.data))
+                    if frame.request is not None and not frame.request.future.done():
+                        frame.request.future.set_exception(XpressNetException("Command station busy"))
+            self.transmit_condition.notify()
+
+    # Called for every frame received from the Elite, the transmitter may go on
+    def reply_received(self):
+        with self.transmit_condition:
+            if self.awaiting_reply_until:
+                self.awaiting_reply_until = 0.0
+                self.transmit_condition.notify()
+
+    # Put a frame back at the front of the queue (caller holds transmit_condition)
+    def requeue_frame(self, frame):
+        if frame.key is not None and frame.request is None:
+            if frame.key in self.pending_frames:
+                return  # Superseded while it was being written
+            self.pending_frames[frame.key] = frame
+        if frame.priority:
+            self.transmit_queue.appendleft(frame)
+        else:
+            self.insert_after_priority(frame)
+
+    # Insert a frame behind the priority frames at the front of the queue (caller holds transmit_condition)
+    def insert_after_priority(self, frame):
+        index = 0
+        while index < len(self.transmit_queue) and self.transmit_queue[index].priority:
+            index += 1
+        self.transmit_queue.insert(index, frame)
+
+    # Return the oldest in-flight request expecting a reply with this header byte
+    def match_request(self, header_byte):
+        with self.transmit_condition:
+            self.expire_requests()
+            for request in self.inflight_requests:
+                if header_byte in request.expects:
+                    self.inflight_requests.remove(request)
+                    return request
+        return None
+
+    # Fail requests whose reply did not arrive in time (caller holds transmit_condition)
+    def expire_requests(self):
+        now = time.monotonic()
+        while self.inflight_requests and self.inflight_requests[0].deadline < now:
+            request = self.inflight_requests.popleft()
+            self.transmit_stats["timeouts"] += 1
+            request.future.set_exception(XpressNetException("Request timed out"))
+
+    def fail_requests(self, reason):
+        with self.transmit_condition:
+            while self.inflight_requests:
+                self.inflight_requests.popleft().future.set_exception(XpressNetException(reason))
+
+    def get_transmit_queue_depth(self):
+        return len(self.transmit_queue)
+
+    def get_transmit_stats(self):
+        with self.transmit_condition:
+            stats = dict(self.transmit_stats)
+            stats["queue_depth"] = len(self.transmit_queue)
+            stats["inflight_requests"] = len(self.inflight_requests)
+            stats["delay"] = self.transmit_delay
+        return stats
+
+    # Read and decode from the port until the link fails (the exception is
+    # raised to the supervisor) or the connection is closed
+    def receive(self):
+        port = self.ser
+        while self.listening:
+            # Block in read() until at least one byte arrives (or the port timeout
+            # expires) instead of spinning on in_waiting. The write lock is
+            # never taken here, so send() is not held up by the reader.
+            data = port.read(1)
+            if not data:
+                with self.transmit_condition:
+                    self.expire_requests()
+                continue
+            waiting = port.in_waiting
+            if waiting > 0:
+                data += port.read(waiting)  # Drain whatever else has already arrived
+            self.last_received = time.monotonic()
+            bytes_received.inc(len(data))
+            sink = self.frame_sink or frame_sink
+            if sink is not None:
+                sink("rx", data)
+            trace_frame("Received", data)
+            self.buffer.extend(data)  # Add to the buffer
+            started = time.perf_counter()
+            self.process_data()  # Process the buffer
+            decode_seconds.observe(time.perf_counter() - started)
+
+    # Process received data. Frames are decoded in place through a memoryview while
+    # read_offset walks the buffer; consumed bytes are only dropped once everything
+    # has been read or COMPACT_THRESHOLD bytes have built up.
+    def process_data(self):
+        debug = root_logger.isEnabledFor(logging.DEBUG)
+        buffer = self.buffer
+        end = len(buffer)
+        with memoryview(buffer) as view:
+            while self.read_offset < end:
+                header_byte = view[self.read_offset]
+                chunk_size = (header_byte & 0x0F) + 2  # Calculate chunk size from the last nibble + 2 (header + data bytes)
+                if end - self.read_offset < chunk_size:
+                    # If there aren't enough bytes yet, wait for more data to arrive
+                    break
+
+                frames_received.inc(label=FRAME_TYPES[header_byte])
+                with view[self.read_offset:self.read_offset + chunk_size] as chunk:
+                    self.read_offset += chunk_size
+                    event = decoders[header_byte](self, chunk)
+                    if event is not None and debug:
+                        event.debug = to_hex(chunk)
+                self.reply_received()
+
+                # Call the callback function if available
+                if self.callback and event is not None:
+                    self.callback(event)
+
+        if self.read_offset == len(buffer):
+            buffer.clear()
+            self.read_offset = 0
+        elif self.read_offset >= COMPACT_THRESHOLD:
+            del buffer[:self.read_offset]
+            self.read_offset = 0
+
+    # Frame decoders. Each takes the frame (a memoryview, header byte first) and
+    # returns the Event to report, or None if there is nothing to report.
+
+    # Loco Status Message (Function and Speed/Direction) returned from Elite after request
+    def decode_loco_information(self, chunk):
+        identification_byte = chunk[1]
+        train_number = decode_train_number(chunk[2], chunk[3])
+        if not state.valid_address(train_number):
+            return None
+
+        if identification_byte == 0xF9:
+            # Function message: Function Group 1 (F0-F4) and Function Group 2 (F5-F12)
+            train = self.get_train(train_number)
+            train.update_function_bytes(chunk[4], chunk[5])
+            functions = dict(FUNCTIONS_F0_F4[chunk[4]])
+            functions.update(FUNCTIONS_F5_F12[chunk[5]])
+            return Event(200, "Loco Function Status", {"train_number": train_number, "functions": functions}, "function")
+
+        if identification_byte == 0xF8:
+            # Speed and direction message
+            train = self.get_train(train_number)
+            speed, direction = speed_direction(chunk[5])
+            train.update_throttle(speed, direction)
+            return Event(200, "Loco Speed/Direction Status", {
+                "train_number": train_number,
+                "direction": "Forward" if direction == FORWARD else "Reverse",
+                "speed": speed
+            }, "throttle")
+
+        return None
+
+    # Loco state message (returned from Elite after getState request, e.g. E40095000071 - No address!)
+    def decode_loco_state(self, chunk):
+        request = self.match_request(0xE4)
+        if request is None:
+            return None
+
+        # The reply belongs to the oldest outstanding request for it
+        train = self.get_train(request.address)
+        version = state.get_version(request.address)
+        if self.stale_readback(request, version):
+            return loco_state_reply(request, train.address, version)
+        speed, direction = speed_direction(chunk[2])
+        train.update_throttle(speed, direction)
+        train.update_function_bytes(chunk[3], chunk[4])
+        self.readback_applied(request)
+        return loco_state_reply(request, train.address, version)
+
+    # Loco state message for functions F13-F28
+    def decode_loco_functions_high(self, chunk):
+        request = self.match_request(0xE3)
+        if request is None:
+            return None
+
+        train = self.get_train(request.address)
+        version = state.get_version(request.address)
+        if self.stale_readback(request, version):
+            return loco_state_reply(request, train.address, version)
+        train.update_high_function_bytes(chunk[2], chunk[3])
+        self.readback_applied(request)
+        return loco_state_reply(request, train.address, version)
+
+    # A read-back is stale if the loco changed after it was queued, other than
+    # through the replies to that read-back itself: the command that changed it
+    # was queued later, so the reply predates it.
+    def stale_readback(self, request, version):
+        if request.version is None:
+            return False
+        return version != request.version and version != self.readback_versions.get(request.address)
+
+    def readback_applied(self, request):
+        if request.version is not None:
+            self.readback_versions[request.address] = state.get_version(request.address)
+
+    # Command Station Status Response
+    def decode_status(self, chunk):
+        if chunk[1] != 0x22:
+            return self.decode_unknown(chunk)
+        status_byte = chunk[2]
+        unchanged = status_byte == self.last_status_byte
+        self.last_status_byte = status_byte
+        data = {
+            "Ready": status_byte == 0x00,
+            "Emergency_Off": bool(status_byte & 0x01),
+            "Emergency_Stop": bool(status_byte & 0x02),
+            "Auto_Start": bool(status_byte & 0x04),
+            "Service_Mode": bool(status_byte & 0x08),
+            "Powering_Up": bool(status_byte & 0x40),
+            "RAM_Check_Error": bool(status_byte & 0x80)
+        }
+
+        # Determine the status code based on the status byte
+        if status_byte & 0x83:  # Emergency off, emergency stop or RAM check error
+            status_code = 500
+        elif status_byte & 0x48:  # Service mode or powering up
+            status_code = 503
+        else:
+            status_code = 200
+        event = Event(status_code, "Status", self.station_data(data))
+
+        # Health probes are quiet, they only report a status that changed
+        request = self.match_request(0x62)
+        if request is not None:
+            if not request.future.done():
+                request.future.set_result(event)
+            if request.quiet and unchanged:
+                return None
+        return event
+
+    def decode_version(self, chunk):
+        if chunk[1] != 0x21:
+            return self.decode_unknown(chunk)
+        version_number = chunk[2] / 100.0
+        return Event(200, "controller", self.station_data({
+            "Make": "Hornby",
+            "Model": "Elite",
+            "Version": f"{version_number:.2f}"
+        }))
+
+    def decode_broadcast(self, chunk):
+        entry = BROADCAST_MESSAGES.get(chunk[1])
+        if entry is None:
+            return self.decode_unknown(chunk)
+        status_code, message, rejection = entry
+        if rejection is not None:
+            self.frame_rejected(rejection)
+        return Event(status_code, message, self.station_data())
+
+    def decode_emergency_off(self, chunk):
+        if chunk[1] != 0x00:
+            return self.decode_unknown(chunk)
+        return Event(500, "Emergency off", self.station_data())
+
+    def decode_command_ok(self, chunk):
+        if chunk[1] != 0x04:
+            return self.decode_unknown(chunk)
+        return Event(200, "Command OK", self.station_data())
+
+    def decode_unknown(self, chunk):
+        return Event(520, f"Unknown data: {to_hex(chunk)}", self.station_data())
+
+    # Event data naming the station it came from, when there are several
+    def station_data(self, data=None):
+        data = data if data is not None else {}
+        if self.name:
+            data["Station"] = self.name
+        return data
+
+    # Return a Train for an address, sending through this connection. Trains are
+    # views onto the state store, so they are cheap to create and every one
+    # for an address sees the same state.
+    def get_train(self, train_number):
+        return Train(train_number, self)
+
+    def get_accessory(self, accessory_number):
+        return Accessory(accessory_number, self)
+
+    # Report the cached state of a train through the callback without asking the Elite
+    def publish_train_state(self, train):
+        if self.callback:
+            self.callback(loco_state_event(train.address))
+
+    # Get version command
+    def getVersion(self):
+        get_version = [0x21, 0x21]
+        self.send(get_version)
+
+    # Get status command
+    def getStatus(self):
+        get_status = [0x21, 0x24]
+        self.send(get_status)
+
+    # Status request used as a liveness probe, returns a Future for the reply
+    def probeStatus(self):
+        get_status = [0x21, 0x24]
+        return self.send(get_status, expects=(0x62,), quiet=True)
+
+    def get_last_received(self):
+        return self.last_received
+
+    # Emergency Off Request, sent ahead of any queued commands
+    def emergencyOff(self):
+        emergency_off = [0x21, 0x80]
+        self.send(emergency_off, priority=True)
+
+    # Resume Normal Operations Request, also sent ahead of queued commands
+    def resumeNormalOperations(self):
+        resume_normal_operations = [0x21, 0x81]
+        self.send(resume_normal_operations, priority=True)
+
+# Broadcasts and replies with header 0x61, keyed on the second byte: (status code, message, rejection)
+BROADCAST_MESSAGES = {
+    0x00: (500, "Track power off", None),
+    0x01: (100, "Normal operations resumed", None),
+    0x02: (503, "In service mode", None),
+    0x80: (400, "Transmission error", "transmission_errors"),
+    0x81: (503, "Command station busy", "busy"),
+    0x82: (400, "Command not supported", None),
+}
+
+# Dispatch table from header byte to decoder, called with the connection and the frame
+decoders = [Connection.decode_unknown] * 256
+decoders[0xE5] = Connection.decode_loco_information
+decoders[0xE4] = Connection.decode_loco_state
+decoders[0xE3] = Connection.decode_loco_functions_high
+decoders[0x62] = Connection.decode_status
+decoders[0x63] = Connection.decode_version
+decoders[0x61] = Connection.decode_broadcast
+decoders[0x81] = Connection.decode_emergency_off
+decoders[0x01] = Connection.decode_command_ok
 
 # Calculate checksum
 def calculate_checksum(data):
@@ -175,292 +769,52 @@ def decode_train_number(high_byte, low_byte):
     else:  # Addresses from 100 to 9999
         return ((high_byte & 0x3F) << 8) | low_byte
 
-# Process received data
-def process_data():
-    global buffer, train_instances, first_response_processed
-    while len(buffer) > 0:
-        header_byte = buffer[0]
-        chunk_size = (header_byte & 0x0F) + 2  # Calculate chunk size from the last nibble + 2 (header + data bytes)
-
-        if len(buffer) >= chunk_size:  # Check if we have enough bytes in the buffer to process this chunk
-            chunk = buffer[:chunk_size]
-            response = {
-                "status_code": 200,
-                "message": None,
-                "data": {},
-                "debug": f"{to_hex(chunk)}"
-            }
-
-            # Handle Loco Status Message (Function and Speed/Direction) returned from Elite after request
-            if chunk[0] == 0xE5 and len(chunk) >= 7:
-                identification_byte = chunk[1]
-
-                # Extract Train Number
-                train_number = decode_train_number(chunk[2], chunk[3])
-
-                # Ensure the train instance exists
-                if train_number not in train_instances:
-                    train_instances[train_number] = Train(train_number)
-
-                train = train_instances[train_number]
-
-                if identification_byte == 0xF9:
-                    # Function message
-                    response["message"] = "Loco Function Status"
-                    response["action"] = "function"
-                    response["data"]["train_number"] = train_number
-
-                    # Decode Function Group 1 (F0-F4) and Function Group 2 (F5-F12)
-                    function_group_0 = chunk[4]
-                    function_group_1 = chunk[5]
-
-                    functions = {
-                        "0": bool(function_group_0 & 0x10),
-                        "1": bool(function_group_0 & 0x01),
-                        "2": bool(function_group_0 & 0x02),
-                        "3": bool(function_group_0 & 0x04),
-                        "4": bool(function_group_0 & 0x08),
-                        "5": bool(function_group_1 & 0x01),
-                        "6": bool(function_group_1 & 0x02),
-                        "7": bool(function_group_1 & 0x04),
-                        "8": bool(function_group_1 & 0x08),
-                        "9": bool(function_group_1 & 0x10),
-                        "10": bool(function_group_1 & 0x20),
-                        "11": bool(function_group_1 & 0x40),
-                        "12": bool(function_group_1 & 0x80),
-                    }
-
-                    response["data"]["functions"] = functions
-
-                    # Update train state
-                    train.update_functions(functions)
-
-                elif identification_byte == 0xF8:
-                    # Speed and direction message
-                    response["message"] = "Loco Speed/Direction Status"
-                    response["action"] = "throttle"
-                    response["data"]["train_number"] = train_number
-                    speed_direction_byte = chunk[5]
-                    direction = REVERSE if speed_direction_byte < 0x80 else FORWARD
-                    speed = speed_direction_byte & 0x7F  # Extract the lower 7 bits for speed (0-127)
-
-                    response["data"]["direction"] = "Forward" if direction == FORWARD else "Reverse"
-                    response["data"]["speed"] = speed
-
-                    # Update train state
-                    train.update_throttle(speed, direction)
-
-            # Handle loco state message (returned from Elite after getState request, e.g. E40095000071 - No address!)
-            elif chunk[0] == 0xE4 and len(chunk) >= 6:
-                identification_byte = chunk[1]
-                if last_requested_train_address is not None:
-                    response["message"] = "Loco State"
-                    response["action"] = "getState"
-                    # Handle the response using the last requested address
-                    train_number = last_requested_train_address
-                    response["data"]["train_number"] = train_number
-
-                    # Ensure the train instance exists
-                    if train_number not in train_instances:
-                        train_instances[train_number] = Train(train_number)
-
-                    train = train_instances[train_number]
-
-                    speed_direction_byte = chunk[2]
-                    direction = REVERSE if speed_direction_byte < 0x80 else FORWARD
-                    speed = speed_direction_byte & 0x7F  # Extract the lower 7 bits for speed (0-127)
-
-                    response["data"]["direction"] = "Forward" if direction == FORWARD else "Reverse"
-                    response["data"]["speed"] = speed
-
-                    # Decode Function Group 1 (F0-F4) and Function Group 2 (F5-F12)
-                    function_group_0 = chunk[3]
-                    function_group_1 = chunk[4]
-
-                    functions = {
-                        "0": bool(function_group_0 & 0x10),
-                        "1": bool(function_group_0 & 0x01),
-                        "2": bool(function_group_0 & 0x02),
-                        "3": bool(function_group_0 & 0x04),
-                        "4": bool(function_group_0 & 0x08),
-                        "5": bool(function_group_1 & 0x01),
-                        "6": bool(function_group_1 & 0x02),
-                        "7": bool(function_group_1 & 0x04),
-                        "8": bool(function_group_1 & 0x08),
-                        "9": bool(function_group_1 & 0x10),
-                        "10": bool(function_group_1 & 0x20),
-                        "11": bool(function_group_1 & 0x40),
-                        "12": bool(function_group_1 & 0x80),
-                    }
-
-                    # Update train state
-                    train.update_throttle(speed, direction)
-                    train.update_functions(functions)
-
-                    # Add functions 13-28 from the train's cached state
-                    for i in range(13, 29):
-                        group_index, _, bitmask = function_table[i]
-                        functions[str(i)] = bool(train.group[group_index] & bitmask)
-
-                    response["data"]["functions"] = functions
-
-                    # Mark the first response as processed
-                    first_response_processed = True
-
-            # Handle loco state message for functions F13-F28
-            elif chunk[0] == 0xE3 and len(chunk) >= 5:
-                identification_byte = chunk[1]
-                if last_requested_train_address is not None:
-                    response["message"] = "Loco State"
-                    response["action"] = "getState"
-                    # Handle the response using the last requested address
-                    train_number = last_requested_train_address
-                    response["data"]["train_number"] = train_number
-
-                    # Ensure the train instance exists
-                    if train_number not in train_instances:
-                        train_instances[train_number] = Train(train_number)
-
-                    train = train_instances[train_number]
-
-                    # Decode Function Group 3 (F13-F20) and Function Group 4 (F21-F28)
-                    function_group_2 = chunk[2]
-                    function_group_3 = chunk[3]
-
-                    functions = {
-                        "13": bool(function_group_2 & 0x01),
-                        "14": bool(function_group_2 & 0x02),
-                        "15": bool(function_group_2 & 0x04),
-                        "16": bool(function_group_2 & 0x08),
-                        "17": bool(function_group_2 & 0x10),
-                        "18": bool(function_group_2 & 0x20),
-                        "19": bool(function_group_2 & 0x40),
-                        "20": bool(function_group_2 & 0x80),
-                        "21": bool(function_group_3 & 0x01),
-                        "22": bool(function_group_3 & 0x02),
-                        "23": bool(function_group_3 & 0x04),
-                        "24": bool(function_group_3 & 0x08),
-                        "25": bool(function_group_3 & 0x10),
-                        "26": bool(function_group_3 & 0x20),
-                        "27": bool(function_group_3 & 0x40),
-                        "28": bool(function_group_3 & 0x80),
-                    }
-
-                    # Update train state
-                    train.update_functions(functions)
-
-                    for i in range(0, 13):
-                        group_index, _, bitmask = function_table[i]
-                        functions[str(i)] = bool(train.group[group_index] & bitmask)
-
-                    response["data"]["functions"] = functions
-
-            # Handle Command Station Status Response (200 OK)
-            elif chunk[0] == 0x62 and chunk[1] == 0x22 and len(chunk) >= 3:
-                status_byte = chunk[2]
-                response["message"] = "Status"
-                response["data"] = {
-                    "Ready": status_byte == 0x00,
-                    "Emergency_Off": bool(status_byte & 0x01),
-                    "Emergency_Stop": bool(status_byte & 0x02),
-                    "Auto_Start": bool(status_byte & 0x04),
-                    "Service_Mode": bool(status_byte & 0x08),
-                    "Powering_Up": bool(status_byte & 0x40),
-                    "RAM_Check_Error": bool(status_byte & 0x80)
-                }
-
-                # Determine the status code and message based on the status byte
-                if response["data"]["Emergency_Off"] or response["data"]["Emergency_Stop"] or response["data"]["RAM_Check_Error"]:
-                    response["status_code"] = 500
-#                    response["message"] = "Internal Server Error"
-                elif response["data"]["Service_Mode"] or response["data"]["Powering_Up"]:
-                    response["status_code"] = 503
-#                    response["message"] = "Service Unavailable"
-                elif response["data"]["Ready"]:
-                    response["status_code"] = 200
-#                    response["message"] = "Ready"
-                else:
-                    response["status_code"] = 200
-
-            # Handle known sequences
-            elif chunk[0] == 0x63 and chunk[1] == 0x21 and len(chunk) >= 3:
-                version_byte = chunk[2]
-                version_number = version_byte / 100.0
-                response["status_code"] = 200  # OK
-                response["message"] = "controller"
-                response["data"] = {
-                    "Make": "Hornby",
-                    "Model": "Elite",
-                    "Version": f"{version_number:.2f}"
-                }
-
-            elif chunk[:3] == b'\x61\x00\x61':
-                response["status_code"] = 500  # Server Error
-                response["message"] = "Track power off"
-
-            elif chunk[:3] == b'\x61\x01\x60':
-                response["status_code"] = 100  # Continue
-                response["message"] = "Normal operations resumed"
-
-            elif chunk[:3] == b'\x81\x00\x81':
-                response["status_code"] = 500  # Server Error
-                response["message"] = "Emergency off"
-
-            elif chunk[:3] == b'\x61\x02\x63':
-                response["status_code"] = 503  # Service Unavailable
-                response["message"] = "In service mode"
-
-            elif chunk[:3] == b'\x01\x04\x05':
-                response["status_code"] = 200  # Server Error
-                response["message"] = "Command OK"
-
-            elif chunk[:2] == b'\x61\x80':
-                response["status_code"] = 400  # Bad Request
-                response["message"] = "Transmission error"
-
-            elif chunk[:2] == b'\x61\x81':
-                response["status_code"] = 503  # Service Unavailable
-                response["message"] = "Command station busy"
-
-            elif chunk[:2] == b'\x61\x82':
-                response["status_code"] = 400  # Bad Request
-                response["message"] = "Command not supported"
-
-            else:
-                response["status_code"] = 520  # Unknown Error
-                response["message"] = f"Unknown data: {to_hex(chunk)}"
-
-            # Convert the response to JSON
-            json_message = json.dumps(response)
-
-            # Call the callback function if available
-            if callback and response["message"]:
-                callback(json_message)
-
-            buffer = buffer[chunk_size:]  # Remove the processed chunk from the buffer
-        else:
-            # If there aren't enough bytes yet, wait for more data to arrive
-            break
-
-# Get version command
-def getVersion():
-    get_version = [0x21, 0x21]
-    send(get_version)
-
-# Get status command
-def getStatus():
-    get_status = [0x21, 0x24]
-    send(get_status)
-
-# Emergency Off Request
-def emergencyOff():
-    emergency_off = [0x21, 0x80]
-    send(emergency_off)
-
-# Emergency Off Request
-def resumeNormalOperations():
-    resume_normal_operations = [0x21, 0x81]
-    send(resume_normal_operations)
+# Precomputed function lookup tables, indexed by the raw byte value from the Elite.
+# Each entry maps the function numbers carried by that byte to their on/off state.
+def function_bit_table(numbers_and_masks):
+    return [
+        {str(number): bool(value & bitmask) for number, bitmask in numbers_and_masks}
+        for value in range(256)
+    ]
+
+FUNCTIONS_F0_F4 = function_bit_table([(0, 0x10), (1, 0x01), (2, 0x02), (3, 0x04), (4, 0x08)])
+FUNCTIONS_F5_F12 = function_bit_table([(5 + i, 1 << i) for i in range(8)])
+FUNCTIONS_F13_F20 = function_bit_table([(13 + i, 1 << i) for i in range(8)])
+FUNCTIONS_F21_F28 = function_bit_table([(21 + i, 1 << i) for i in range(8)])
+
+# Functions F0-F28 of a loco, built from its group bytes in the state store
+def train_functions(address):
+    group = state.get_groups(address)
+    functions = dict(FUNCTIONS_F0_F4[group[0]])
+    functions.update(FUNCTIONS_F5_F12[group[1] | (group[2] << 4)])
+    functions.update(FUNCTIONS_F13_F20[group[3]])
+    functions.update(FUNCTIONS_F21_F28[group[4]])
+    return functions
+
+def speed_direction(speed_direction_byte):
+    direction = REVERSE if speed_direction_byte < 0x80 else FORWARD
+    speed = speed_direction_byte & 0x7F  # Extract the lower 7 bits for speed (0-127)
+    return speed, direction
+
+# Complete a loco state request. A quiet request whose reply matched the
+# cached state (the version did not move) resolves without an event.
+def loco_state_reply(request, address, version):
+    event = loco_state_event(address)
+    if not request.future.done():
+        request.future.set_result(event)
+    if request.quiet and state.get_version(address) == version:
+        return None
+    return event
+
+# The cached state of a loco as a "Loco State" event, whichever station drives it
+def loco_state_event(address):
+    speed, direction = speed_direction(state.get_speed_direction(address))
+    return Event(200, "Loco State", {
+        "train_number": address,
+        "direction": "Forward" if direction == FORWARD else "Reverse",
+        "speed": speed,
+        "functions": train_functions(address)
+    }, "getState")
 
 def generate_function_table():
     global function_table
@@ -478,39 +832,68 @@ def generate_function_table():
     # Group 4 (F21-F28)
     function_table.extend([[4, 0x28, 1 << i] for i in range(8)])
 
-# Train control class
+# The table is the same for every connection, so it is built once
+generate_function_table()
+
+# Train control class, a view onto the loco's entry in the state store that
+# sends its commands through the connection to the loco's command station
 class Train:
-    def __init__(self, address):
+    __slots__ = ("address", "connection")
+
+    def __init__(self, address, connection):
+        if not state.valid_address(address):
+            raise XpressNetException(f"Invalid loco address: {address}")
         self.address = address
-        self.group = [0, 0, 0, 0, 0]  # Initialize the state of function groups (F0-F28)
-        self.speed = 0
-        self.direction = FORWARD
+        self.connection = connection
+        state.register(address)
+
+    @property
+    def speed(self):
+        return state.get_speed_direction(self.address) & 0x7F
 
-    def getState(self):
-        global last_requested_train_address, first_response_processed
-        # Set the global variable to the current train address
-        last_requested_train_address = self.address
-        first_response_processed = False  # Reset the flag
+    @property
+    def direction(self):
+        return FORWARD if state.get_speed_direction(self.address) & 0x80 else REVERSE
 
-        # Construct the function states (first part)
+    # Copy of the function group bytes (F0-F4, F5-F8, F9-F12, F13-F20, F21-F28)
+    @property
+    def group(self):
+        return state.get_groups(self.address)
+
+    # Returns a Future resolving with the full "Loco State" Event once both replies are decoded
+    def getState(self, quiet=False):
+        # Construct the function states (first part, answered by 0xE4: speed and F0-F12)
         message = bytearray(b'\xE3\x00\x00\x00')
         struct.pack_into(">H", message, 2, self.address)
         xor_byte = calculate_checksum(message)
         message.append(xor_byte)
-        send(message)
+        self.connection.send(message, expects=(0xE4,), address=self.address, quiet=quiet)
 
-        # Construct the function states (second part)
+        # Construct the function states (second part, answered by 0xE3: F13-F28)
         message = bytearray(b'\xE3\x08\x00\x00')
         struct.pack_into(">H", message, 2, self.address)
         xor_byte = calculate_checksum(message)
         message.append(xor_byte)
-        send(message)
+        reply = self.connection.send(message, expects=(0xE3,), address=self.address, quiet=quiet)
+
+        # Replies are decoded in order, so the cache is complete once the second one is in
+        result = Future()
+        def complete(reply):
+            if reply.exception() is not None:
+                result.set_exception(reply.exception())
+            else:
+                result.set_result(loco_state_event(self.address))
+        reply.add_done_callback(complete)
+        return result
 
 
+    # The state is only updated once the frame is queued
     def throttle(self, speed, direction):
-        self.speed = speed
-        self.direction = direction
+        self.connection.send(*self.throttle_frame(speed, direction))
+        self.update_throttle(speed, direction)
 
+    # Build the speed frame, returning (message, coalescing key). The state is left unchanged.
+    def throttle_frame(self, speed, direction):
         message = bytearray(b'\xE4\x00\x00\x00\x00')
         message[1] = 0x13
         struct.pack_into(">H", message, 2, self.address)
@@ -524,7 +907,8 @@ class Train:
         xor_byte = calculate_checksum(message)
         message.append(xor_byte)
 
-        send(message)
+        # A newer speed for this loco replaces one that is still queued
+        return message, (self.address, 0x13)
 
     # The Hornby ELITE does not support emergency stop of a locomotive, so do not set a deceleration rate in the decoder
     def stop(self):
@@ -533,9 +917,17 @@ class Train:
         #struct.pack_into(">H", message, 1, self.address)
         #xor_byte = calculate_checksum(message)
         #message.append(xor_byte)
-        #send(message)
+        #self.connection.send(message)
 
     def function(self, num, switch):
+        self.connection.send(*self.function_frame(num, switch))
+        self.update_function(num, switch)
+
+    # Build the function group frame, returning (message, coalescing key). The
+    # function is switched in groups, a copy of the group bytes (by default the
+    # stored ones), so a batch can build several frames on its own copy; the
+    # state is left unchanged.
+    def function_frame(self, num, switch, groups=None):
         if num >= len(function_table):
             raise RuntimeError('Invalid function')
 
@@ -543,71 +935,127 @@ class Train:
         message = bytearray(b'\xE4\x00\x00\x00\x00')
         message[1] = header_byte
 
-        if switch == ON:
-            self.group[group_index] |= bitmask  # Turn on the function
-        elif switch == OFF:
-            self.group[group_index] &= ~bitmask  # Turn off the function
-        else:
+        if switch not in (ON, OFF):
             raise RuntimeError('Invalid switch on function')
 
-        message[4] = self.group[group_index]
+        if groups is None:
+            groups = self.group
+        if switch == ON:
+            groups[group_index] |= bitmask
+        else:
+            groups[group_index] &= ~bitmask & 0xFF
+        message[4] = groups[group_index]
         struct.pack_into(">H", message, 2, self.address)
 
         # Calculate the XOR byte (checksum) using the global function
         xor_byte = calculate_checksum(message)
         message.append(xor_byte)
 
-        send(message)
+        # The frame carries the whole group, so a newer one for the same group replaces it
+        return message, (self.address, header_byte)
 
     def update_throttle(self, speed, direction):
-        self.speed = speed
-        self.direction = direction
+        state.set_speed_direction(self.address, (speed & 0x7F) | (0x80 if direction == FORWARD else 0))
+
+    def update_function(self, num, switch):
+        group_index, _, bitmask = function_table[num]
+        state.update_group(self.address, group_index, bitmask, switch == ON)
 
     def update_functions(self, functions):
     # Update each function's state based on the received data
         for i in range(29):  # Loop through all functions F0-F28
             if str(i) in functions:
-                state = functions[str(i)]
                 group_index, _, bitmask = function_table[i]  # Retrieve correct group index and bitmask
-
-                if state:
-                    self.group[group_index] |= bitmask  # Turn on the function
-                else:
-                    self.group[group_index] &= ~bitmask  # Turn off the function
+                state.update_group(self.address, group_index, bitmask, functions[str(i)])
+
+    # Update F0-F12 from the raw bytes of a reply (F0-F4 byte, F5-F12 byte)
+    def update_function_bytes(self, f0_f4, f5_f12):
+        state.set_groups(self.address, 0, (f0_f4 & 0x1F, f5_f12 & 0x0F, f5_f12 >> 4))
+
+    # Update F13-F28 from the raw bytes of a reply (F13-F20 byte, F21-F28 byte)
+    def update_high_function_bytes(self, f13_f20, f21_f28):
+        state.set_groups(self.address, 3, (f13_f20, f21_f28))
+
+# A decoded message passed to the callback. The JSON text is built on first
+# use and cached, so it is serialised once however many clients receive it.
+class Event:
+    __slots__ = ("status_code", "message", "data", "action", "debug", "_json")
+
+    def __init__(self, status_code, message, data=None, action=None):
+        self.status_code = status_code
+        self.message = message
+        self.data = data if data is not None else {}
+        self.action = action
+        self.debug = None
+        self._json = None
+
+    def to_dict(self):
+        response = {
+            "status_code": self.status_code,
+            "message": self.message,
+            "data": self.data
+        }
+        if self.action is not None:
+            response["action"] = self.action
+        if self.debug is not None:
+            response["debug"] = self.debug
+        return response
+
+    def to_json(self):
+        if self._json is None:
+            self._json = json.dumps(self.to_dict())
+        return self._json
+
+# A queued outgoing frame
+class Frame:
+    __slots__ = ("data", "key", "request", "retries", "queued_at", "priority")
+
+    def __init__(self, data, key=None, request=None):
+        self.data = data
+        self.key = key
+        self.request = request
+        self.retries = 0
+        self.queued_at = 0.0
+        self.priority = False
+
+# An outstanding request waiting for one of the expected reply headers
+class Request:
+    __slots__ = ("expects", "address", "quiet", "future", "deadline", "version")
+
+    def __init__(self, expects, address=None, quiet=False):
+        self.expects = expects
+        self.address = address
+        self.quiet = quiet
+        self.future = Future()
+        self.deadline = None
+        self.version = None  # Loco version when the request was queued
 
 class Accessory:
-    def __init__(self, address):
+    def __init__(self, address, connection):
         self.offset = address % 4
         self.address = address // 4
+        self.connection = connection
 
     # The following two functions switch turnouts.
     # Output 1 is reverse on the hornby elite
     def activateOutput1(self):
-        message = bytearray(b'\x52\x00\x00')
-        message[1] = self.address
-        #Set activate bit and set output to 1
-        message[2] = 0x80
-        #Set offset bits
-        message[2] |= (self.offset & 0x03) << 1
-
-        xor_byte = calculate_checksum(message)
-        message.append(xor_byte)
-
-        send(message)
+        self.connection.send(self.output_frame(1))
 
     # Output 2 is forward on the hornby elite
     def activateOutput2(self):
+        self.connection.send(self.output_frame(2))
+
+    def output_frame(self, output):
         message = bytearray(b'\x52\x00\x00')
         message[1] = self.address
-        #Set activate bit and set output to 2
-        message[2] = 0x81
+        #Set activate bit and the output (0x80 for output 1, 0x81 for output 2)
+        message[2] = 0x80 if output == 1 else 0x81
         #Set offset bits
         message[2] |= (self.offset & 0x03) << 1
 
         xor_byte = calculate_checksum(message)
         message.append(xor_byte)
-
-        send(message)
+        return message
 
 class XpressNetException(Exception):
     pass
\ No newline at end of file